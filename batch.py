@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+#
+# Helpers to run the same function on many inputs in a process pool,
+# shared by the tools. Only uses the standard library, so importing it is cheap.
+#
+import os, resource
+from concurrent.futures import ProcessPoolExecutor
+
+
+def peak_memory():
+    """Peak resident memory of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def available_memory():
+    """Memory available for new processes in bytes (MemAvailable on Linux)."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def estimate_memory(filename, dtype='float64', chars_per_value=18, n_copies=2, overhead=0):
+    """Rough memory needed to convert a CHGCAR-like file in bytes.
+    The number of grid values is guessed from the file size
+    (CHGCAR: ' 0.12345678901E+01' = 18 characters per value),
+    n_copies is the peak memory in units of all values in the file and accounts
+    for temporaries like np.abs() of a grid, overhead is added independent of the grid size.
+    """
+    import numpy as np
+    n_values = os.path.getsize(filename) / chars_per_value
+    return int(n_copies * n_values * np.dtype(dtype).itemsize + overhead)
+
+
+def run_batch(func, jobs, workers=1, verbose=True, memory=None):
+    """Call func(*args) for every args in jobs, returns the results in order and the
+    first arguments (the input files) of the failed jobs.
+    With workers > 1 the jobs are run in a process pool. A failing job does
+    not abort the batch but gets None as result and is reported at the end.
+    memory: list with the estimated memory per job in bytes, the number
+            of workers is capped so the largest jobs fit into the available memory
+    """
+    workers = min(workers, len(jobs))
+    if workers > 1 and memory:
+        cap = max(1, int(available_memory() // max(memory)))
+        if cap < workers:
+            if verbose: print("ATTENTION: Only using {} of {} workers to not run out of memory".format(cap, workers))
+            workers = cap
+
+    results = []
+    failures = []
+    if workers <= 1:
+        for args in jobs:
+            try:
+                results.append(func(*args))
+            except Exception as e:
+                results.append(None)
+                failures.append((args[0], e))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(func, *args) for args in jobs]
+            for args, future in zip(jobs, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append(None)
+                    failures.append((args[0], e))
+    for inFile, e in failures:
+        print("FAILED: {}: {}".format(inFile, e))
+    if failures:
+        print("{} of {} files failed!".format(len(failures), len(jobs)))
+    return results, [inFile for inFile, e in failures]
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+#
+# Script to benchmark the tools of this collection on synthetic VASP output
+#
+# Generates CHGCAR/ELFCAR grids, XDATCAR/OUTCAR trajectories, vasprun.xml files and
+# NEB folders of increasing size in a temporary folder, runs the main() of every tool
+# on them in a forked process and records the wall time and peak memory as JSON.
+# Compare two JSON files with --compare to find regressions between versions.
+# Everything runs offline, the inputs are reproducible (fixed random seed).
+#
+# You can import the module and use the generators or use it as a script
+from ase import Atoms
+from ase.io import write
+from contextlib import redirect_stdout
+import multiprocessing as mp
+import numpy as np
+import json, os, platform, resource, shutil, subprocess, tempfile, time
+
+#sizes of the inputs per benchmark, --quick only uses the first one
+SIZES = {
+    'chgcar2cube': [24, 48, 96],     #grid points per axis
+    'elf2cube': [24, 48, 96],
+    'vasp2traj-xdatcar': [100, 1000, 10000],  #frames
+    'vasp2traj-outcar': [100, 1000, 5000],
+    'vasp2traj-xdatcar-sequential': [100, 1000, 10000],
+    'vasp2traj-outcar-sequential': [100, 1000, 5000],
+    'vasprunscan': [10, 100, 500],   #ionic steps
+    'vaspcheck': [10, 100, 1000],    #k-points
+    'neb2movie': [5, 15, 45],        #images
+    'plotNEB': [5, 15, 45],
+}
+
+
+def _atoms(natoms, seed=0, a=10.0):
+    rng = np.random.default_rng(seed)
+    symbols = ['Cu'] * (natoms - natoms // 2) + ['O'] * (natoms // 2)
+    return Atoms(symbols, scaled_positions=rng.random((natoms, 3)), cell=np.eye(3) * a, pbc=True)
+
+
+def _format_values(f, values, per_line=5, fmt=' {:17.11E}'):
+    """Write values with per_line values per line like VASP, formatting whole blocks at once."""
+    rows = len(values) // per_line
+    line = fmt * per_line + '\n'
+    block = 4096
+    for start in range(0, rows, block):
+        stop = min(rows, start + block)
+        f.write((line * (stop - start)).format(*values[start*per_line:stop*per_line]))
+    rest = values[rows*per_line:]
+    if len(rest):
+        f.write((fmt * len(rest) + '\n').format(*rest))
+
+
+def write_chgcar(filename, n, spin=True, natoms=8, elf=False, seed=0):
+    """Synthetic CHGCAR (or ELFCAR with elf=True, values between 0 and 1) with a n*n*n grid."""
+    rng = np.random.default_rng(seed)
+    atoms = _atoms(natoms, seed)
+    with open(filename, 'w') as f:
+        write(f, atoms, format='vasp', direct=True)
+        grids = ['total', 'diff'] if spin else ['total']
+        for key in grids:
+            f.write('\n{:5d}{:5d}{:5d}\n'.format(n, n, n))
+            if elf:
+                values = rng.random(n**3)
+            elif key == 'total':
+                values = rng.random(n**3) * atoms.get_volume()
+            else:
+                values = (rng.random(n**3) - 0.5) * atoms.get_volume()
+            _format_values(f, values)
+
+
+def write_xdatcar(filename, nframes, natoms=32, seed=0):
+    """Synthetic XDATCAR with nframes frames."""
+    rng = np.random.default_rng(seed)
+    atoms = _atoms(natoms, seed)
+    images = []
+    for _ in range(nframes):
+        image = atoms.copy()
+        image.rattle(0.05, seed=int(rng.integers(2**31)))
+        images.append(image)
+    write(filename, images, format='vasp-xdatcar')
+
+
+def write_outcar(filename, nframes, natoms=32, seed=0, edisp=None):
+    """Synthetic OUTCAR of a geometry optimization with nframes ionic steps, readable by ASE.
+    edisp: dispersion energy to write into every step
+    """
+    rng = np.random.default_rng(seed)
+    atoms = _atoms(natoms, seed)
+    nCu = natoms - natoms // 2
+    with open(filename, 'w') as f:
+        f.write(" vasp.6.3.0 synthetic\n POTCAR:    PAW_PBE Cu 22Jun2005\n POTCAR:    PAW_PBE O 08Apr2002\n"
+                " POTCAR:    PAW_PBE Cu 22Jun2005\n POTCAR:    PAW_PBE O 08Apr2002\n")
+        f.write("   ions per type =               {}  {}\n".format(nCu, natoms - nCu))
+        f.write("   Dimension of arrays:\n   k-points           NKPTS =      1   k-points in BZ     NKDIM =      1"
+                "   number of bands    NBANDS=      8\n")
+        f.write(" k-points in reciprocal lattice and weights: \n   0.00000000  0.00000000  0.00000000       1.000\n\n")
+        for i in range(nframes):
+            f.write("--------------------------------------- Iteration {:6d}(  12)  ---------------------------------------\n".format(i+1))
+            f.write("  direct lattice vectors                 reciprocal lattice vectors\n")
+            for r in atoms.cell[:]:
+                f.write("  {:12.9f} {:12.9f} {:12.9f}    0.1 0.0 0.0\n".format(*r))
+            f.write("\n POSITION                                       TOTAL-FORCE (eV/Angst)\n"
+                    " -----------------------------------------------------------------------------------\n")
+            data = np.hstack([atoms.positions + rng.normal(scale=0.05, size=(natoms, 3)), rng.normal(scale=0.1, size=(natoms, 3))])
+            f.write(("  {:12.5f} {:12.5f} {:12.5f}  {:12.6f} {:12.6f} {:12.6f}\n" * natoms).format(*data.ravel()))
+            f.write(" -----------------------------------------------------------------------------------\n")
+            if edisp is not None:
+                f.write("  Edisp (eV)  =  {:.6f}\n".format(edisp))
+            e = -10 - i * 0.01
+            f.write("  FREE ENERGIE OF THE ION-ELECTRON SYSTEM (eV)\n  ---------------------------------------------------\n"
+                    "  free  energy   TOTEN  =       {:.8f} eV\n\n  energy  without entropy=      {:.8f}  energy(sigma->0) =      {:.8f}\n".format(e, e, e))
+        f.write(" reached required accuracy - stopping structural energy minimisation\n")
+
+
+def _varray(name, array, fmt=' {:16.8f}'):
+    line = '   <v>' + fmt * array.shape[1] + ' </v>\n'
+    return '  <varray name="{}" >\n'.format(name) + (line * len(array)).format(*array.ravel()) + '  </varray>\n'
+
+
+def write_vasprun(filename, nsteps, nkpoints=1, nbands=16, natoms=8, spin=True, seed=0):
+    """Synthetic vasprun.xml with nsteps ionic steps, the last one with eigenvalues and
+    occupations for nkpoints k-points."""
+    rng = np.random.default_rng(seed)
+    atoms = _atoms(natoms, seed)
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n<modeling>\n <generator>\n  <i name="program" type="string">vasp </i>\n </generator>\n')
+        f.write(' <structure name="initialpos" >\n  <crystal>\n' + _varray('basis', atoms.cell[:]) + '  </crystal>\n'
+                + _varray('positions', atoms.get_scaled_positions()) + ' </structure>\n')
+        for i in range(nsteps):
+            e = -10.0 - 0.5 * np.exp(-i / 10)
+            f.write(' <calculation>\n')
+            for k in range(10):
+                f.write('  <scstep>\n   <energy>\n    <i name="e_fr_energy">   {:16.8f} </i>\n   </energy>\n  </scstep>\n'.format(e + 1.0 / (k + 1)))
+            f.write(' <structure>\n  <crystal>\n' + _varray('basis', atoms.cell[:]) + '  </crystal>\n'
+                    + _varray('positions', atoms.get_scaled_positions()) + ' </structure>\n')
+            f.write(_varray('forces', rng.normal(scale=np.exp(-i / 20), size=(natoms, 3))))
+            if i == nsteps - 1:
+                occ = np.zeros((2 if spin else 1, nkpoints, nbands))
+                occ[..., :nbands // 2] = 1.0 if spin else 2.0
+                f.write('  <eigenvalues>\n   <array>\n    <dimension dim="1">band</dimension>\n    <field>eigene</field>\n    <field>occ</field>\n    <set>\n')
+                row = '       <r> {:10.4f} {:10.4f} </r>\n' * nbands
+                for s in range(occ.shape[0]):
+                    f.write('     <set comment="spin {}">\n'.format(s + 1))
+                    for k in range(nkpoints):
+                        values = np.stack([np.linspace(-10, 5, nbands), occ[s, k]], axis=1)
+                        f.write('      <set comment="kpoint {}">\n'.format(k + 1) + row.format(*values.ravel()) + '      </set>\n')
+                    f.write('     </set>\n')
+                f.write('    </set>\n   </array>\n  </eigenvalues>\n')
+            f.write('  <energy>\n   <i name="e_fr_energy">   {:16.8f} </i>\n   <i name="e_wo_entrp">   {:16.8f} </i>\n'
+                    '   <i name="e_0_energy">   {:16.8f} </i>\n  </energy>\n </calculation>\n'.format(e, e, e))
+        f.write('</modeling>\n')
+
+
+def write_neb(path, nimages, natoms=32, nframes=5, seed=0):
+    """Synthetic VTST NEB with nimages images (including the end points) in path:
+    00..NN with POSCAR, OUTCAR and CONTCAR (intermediate images), neb.dat and spline.dat."""
+    atoms = _atoms(natoms, seed)
+    shift = np.random.default_rng(seed).normal(scale=0.5, size=(natoms, 3))
+    for i in range(nimages):
+        folder = os.path.join(path, '{:02d}'.format(i))
+        os.makedirs(folder, exist_ok=True)
+        image = atoms.copy()
+        image.positions += shift * i / (nimages - 1)
+        write(os.path.join(folder, 'POSCAR'), image, format='vasp', direct=True)
+        if 0 < i < nimages - 1:
+            write(os.path.join(folder, 'CONTCAR'), image, format='vasp', direct=True)
+        write_outcar(os.path.join(folder, 'OUTCAR'), nframes, natoms, seed + i, edisp=-1.0 - 0.1 * np.sin(np.pi * i / (nimages - 1)))
+    x = np.arange(nimages) * 0.5
+    energies = 0.5 * np.sin(np.pi * np.arange(nimages) / (nimages - 1))
+    forces = 0.5 * np.pi / (nimages - 1) / 0.5 * np.cos(np.pi * np.arange(nimages) / (nimages - 1))
+    np.savetxt(os.path.join(path, 'neb.dat'), np.stack([np.arange(nimages), x, energies, forces, np.arange(nimages)], axis=1))
+    xs = np.linspace(0, x[-1], 10 * nimages)
+    np.savetxt(os.path.join(path, 'spline.dat'), np.stack([xs / 0.5, xs, 0.5 * np.sin(np.pi * xs / x[-1])], axis=1))
+
+
+def _setup_chgcar2cube(path, n):
+    import chgcar2cube
+    write_chgcar(os.path.join(path, 'CHGCAR'), n)
+    return lambda: chgcar2cube.main([os.path.join(path, 'CHGCAR')], [os.path.join(path, 'out')])
+
+
+def _setup_elf2cube(path, n):
+    import elf2cube
+    write_chgcar(os.path.join(path, 'ELFCAR'), n, elf=True)
+    return lambda: elf2cube.main([os.path.join(path, 'ELFCAR')], [os.path.join(path, 'out')])
+
+
+def _vasp2traj(path, inFile, index):
+    import vasp2traj
+    def func():
+        #runs in the forked process, the frame index is built from scratch in every run
+        os.environ['VASPTOOLS_CACHE'] = os.path.join(path, 'cache')
+        shutil.rmtree(os.environ['VASPTOOLS_CACHE'], ignore_errors=True)
+        vasp2traj.main(os.path.join(path, 'out.xyz'), [inFile], False, index=index)
+    return func
+
+
+def _setup_xdatcar(path, n, index=True):
+    write_xdatcar(os.path.join(path, 'XDATCAR'), n)
+    return _vasp2traj(path, os.path.join(path, 'XDATCAR'), index)
+
+
+def _setup_outcar(path, n, index=True):
+    write_outcar(os.path.join(path, 'OUTCAR'), n)
+    return _vasp2traj(path, os.path.join(path, 'OUTCAR'), index)
+
+
+def _setup_vasprunscan(path, n):
+    #vasp-combine-vef.py is a plain script, its work is done by vasprunscan
+    import vasprunscan
+    files = []
+    for i in range(4):
+        os.makedirs(os.path.join(path, str(i)))
+        files.append(os.path.join(path, str(i), 'vasprun.xml'))
+        write_vasprun(files[-1], n, natoms=32, seed=i)
+    return lambda: vasprunscan.read_many(files)
+
+
+def _setup_vaspcheck(path, n):
+    import vaspcheck
+    write_vasprun(os.path.join(path, 'vasprun.xml'), 5, nkpoints=n, nbands=64)
+    write_outcar(os.path.join(path, 'OUTCAR'), 5)
+    with open(os.path.join(path, 'INCAR'), 'w') as f:
+        f.write('IBRION = 2\nNSW = 100\n')
+    return lambda: vaspcheck.main(path)
+
+
+def _setup_neb2movie(path, n):
+    import neb2movie
+    write_neb(path, n)
+    return lambda: neb2movie.main(os.path.join(path, 'movie.xyz'), path)
+
+
+def _setup_plotNEB(path, n):
+    import plotNEB
+    write_neb(path, n)
+    return lambda: plotNEB.main(plot_all=True, plot_dispersion=True, workdir=path)
+
+
+SETUPS = {
+    'chgcar2cube': _setup_chgcar2cube,
+    'elf2cube': _setup_elf2cube,
+    'vasp2traj-xdatcar': _setup_xdatcar,
+    'vasp2traj-outcar': _setup_outcar,
+    'vasp2traj-xdatcar-sequential': lambda path, n: _setup_xdatcar(path, n, index=False),
+    'vasp2traj-outcar-sequential': lambda path, n: _setup_outcar(path, n, index=False),
+    'vasprunscan': _setup_vasprunscan,
+    'vaspcheck': _setup_vaspcheck,
+    'neb2movie': _setup_neb2movie,
+    'plotNEB': _setup_plotNEB,
+}
+
+
+def _child(func, conn):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    start = time.perf_counter()
+    try:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            func()
+        error = None
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    conn.send({'seconds': seconds, 'peak_mb': peak, 'baseline_mb': baseline, 'error': error})
+    conn.close()
+
+
+def measure(func):
+    """Wall time and peak memory (MB) of func() in a forked process."""
+    parent, child = mp.get_context('fork').Pipe()
+    process = mp.get_context('fork').Process(target=_child, args=(func, child))
+    process.start()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def _version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(benchmarks=None, quick=False, repeat=1, verbose=True, tmpdir=None):
+    """Run the benchmarks (keys of SETUPS, default all) for all SIZES.
+    Returns the results as dict, every entry has benchmark, size, seconds (best of repeat),
+    peak_mb and baseline_mb (resident memory before main() was called).
+    """
+    results = []
+    benchmarks = benchmarks or list(SETUPS)
+    unknown = [name for name in benchmarks if name not in SETUPS]
+    if unknown:
+        raise ValueError("Unknown benchmarks: {}".format(', '.join(unknown)))
+    for name in benchmarks:
+        for size in SIZES[name][:1] if quick else SIZES[name]:
+            path = tempfile.mkdtemp(prefix='vasptools-bench-', dir=tmpdir)
+            try:
+                func = SETUPS[name](path, size)
+                runs = [measure(func) for _ in range(repeat)]
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+            best = min(runs, key=lambda r: r['seconds'])
+            best.update({'benchmark': name, 'size': size, 'peak_mb': max(r['peak_mb'] for r in runs)})
+            results.append(best)
+            if verbose:
+                print("{:28s} {:8d} {:10.3f} s {:10.1f} MB{}".format(
+                      name, size, best['seconds'], best['peak_mb'] - best['baseline_mb'],
+                      '  FAILED: ' + best['error'] if best['error'] else ''))
+    return {'version': _version(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count(), 'results': results}
+
+
+def compare(oldFile, newFile):
+    """Print the time and memory ratio new/old of all benchmarks present in both files."""
+    with open(oldFile) as f:
+        old = {(r['benchmark'], r['size']): r for r in json.load(f)['results']}
+    with open(newFile) as f:
+        new = json.load(f)['results']
+    print("{:28s} {:>8s} {:>10s} {:>10s}".format('benchmark', 'size', 'time', 'memory'))
+    for r in new:
+        o = old.get((r['benchmark'], r['size']))
+        if o is None or o['error'] or r['error']:
+            continue
+        memory = (r['peak_mb'] - r['baseline_mb']) / max(o['peak_mb'] - o['baseline_mb'], 1e-3)
+        print("{:28s} {:8d} {:9.2f}x {:9.2f}x".format(r['benchmark'], r['size'], r['seconds'] / o['seconds'], memory))
+
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the tools on synthetic VASP output and store the results as JSON.')
+    parser.add_argument('benchmarks', type=str, nargs='*', help='Benchmarks to run ({}), default: all'.format(', '.join(SETUPS)), default=[])
+    parser.add_argument('-o', type=str, help='Output JSON file', default='benchmark.json')
+    parser.add_argument('--quick', help='Only run the smallest size of every benchmark', action='store_true')
+    parser.add_argument('--repeat', help='Repeat every run, report the fastest', type=int, default=1)
+    parser.add_argument('--tmpdir', help='Folder for the generated inputs, default: system temp', default=None)
+    parser.add_argument('--compare', type=str, help='Compare the output file with this earlier result, does not run anything', default=None)
+    args = parser.parse_args()
+    if args.compare:
+        compare(args.compare, args.o)
+    else:
+        results = run(args.benchmarks or None, args.quick, args.repeat, tmpdir=args.tmpdir)
+        with open(args.o, 'w') as f:
+            json.dump(results, f, indent=1)
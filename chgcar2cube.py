@@ -5,80 +5,470 @@
 # 2022/04/04
 #
 # You can import the module and then call .main() or use it as a script
-from curses import has_key
-from pymatgen.io.vasp.outputs import Chgcar
-from pymatgen.io.ase import AseAtomsAdaptor
-from ase.io.cube import write_cube
+from ase.io.vasp import read_vasp
+from ase.units import Bohr
+from batch import estimate_memory, peak_memory, run_batch
+from io import StringIO
+from itertools import islice
+from profiling import add_profile_arguments, profile, setup, stage
 import numpy as np
-import os
-
-
-def main(inFiles, outFiles, verbose=True, return_integrals=False, return_spin_integrals=False, mult_volume=False):
-    assert len(inFiles) == len(outFiles), "Number of input and output files must be equal!"
-    integrals = []
-    spin_integrals = []
-    for iFile,inFile in enumerate(inFiles):
-        if not os.path.isfile(inFile):
-            raise ValueError('File {:} does not exist'.format(inFile))
-
-        #if output exists mv to .bak
-        if os.path.isfile(outFiles[iFile]):
-            if verbose: print('ATTENTION: {:} exists, moving to *.bak'.format(outFiles[iFile]))
-            os.rename(outFiles[iFile], outFiles[iFile]+'.bak')
-
-        if verbose: print("Reading {}".format(inFile))
-        full_chgcar = Chgcar.from_file(inFile)
-        spinpol = 'diff' in full_chgcar.data.keys()
-        if return_spin_integrals and not spinpol:
-            raise ValueError("File {} is not spinpolarized!".format(inFile))
-        shape = full_chgcar.data['total'].shape
-        n_data = np.prod(shape)
-        
-        if return_integrals:
-            integrals.append(np.sum(np.abs(full_chgcar.data['total'])))
-            integrals[-1] /= n_data
-        if return_spin_integrals:
-            spin_integrals.append(np.sum(np.abs(full_chgcar.data['diff'])))
-            spin_integrals[-1] /= n_data
-        if verbose:
-            print("Shape of data: {}".format(shape))
-            print("Total number of datapoints: {}".format(n_data))
-            if return_integrals:
-                integral = integrals[-1]
+import gzip, os, time
+
+
+def _iter_grid(f, n_data, dtype, chunk_lines):
+    """Parse one grid block of n_data values, yields arrays of chunk_lines lines at a time."""
+    first = np.fromstring(f.readline(), dtype=dtype, sep=' ')
+    per_line = len(first)
+    if per_line == 0:
+        raise ValueError("Could not read grid data")
+    count = min(per_line, n_data)
+    yield first[:count]
+    while count < n_data:
+        n_lines = min(chunk_lines, -(-(n_data - count) // per_line))
+        chunk = np.fromstring(b''.join(islice(f, n_lines)), dtype=dtype, sep=' ')
+        if len(chunk) == 0 or count + len(chunk) > n_data:
+            raise ValueError("Grid data does not match the grid dimensions")
+        count += len(chunk)
+        yield chunk
+
+
+def _read_grid(f, shape, dtype, chunk_lines):
+    """Parse one grid block into a preallocated array, chunk_lines lines at a time."""
+    flat = np.empty(int(np.prod(shape)), dtype=dtype)
+    count = 0
+    for chunk in _iter_grid(f, len(flat), dtype, chunk_lines):
+        flat[count:count+len(chunk)] = chunk
+        count += len(chunk)
+    #VASP writes x fastest
+    return flat.reshape(shape, order='F')
+
+
+def _read_header(f, filename):
+    """Read the structure and the grid dimensions, returns atoms, the tokens of the dimension line and the shape."""
+    header = []
+    for line in f:
+        if not line.strip() and header:
+            break
+        header.append(line.decode())
+    atoms = read_vasp(StringIO(''.join(header)))
+
+    dim_tokens = f.readline().split()
+    shape = tuple(int(d) for d in dim_tokens)
+    if len(shape) != 3:
+        raise ValueError("Could not read grid dimensions from {}".format(filename))
+    return atoms, dim_tokens, shape
+
+
+def _next_grid(f, dim_tokens, keep_augmentation):
+    """Advance f to the next grid header.
+    Returns True if another grid follows and the augmentation occupancies
+    found on the way (empty list unless keep_augmentation).
+    """
+    aug = []
+    remaining = 0
+    for line in f:
+        tokens = line.split()
+        if tokens == dim_tokens:
+            return True, aug
+        if not keep_augmentation:
+            continue
+        if tokens[:2] == [b'augmentation', b'occupancies']:
+            remaining = int(tokens[-1])
+            aug.append([])
+        elif remaining > 0:
+            values = [float(t) for t in tokens]
+            aug[-1].extend(values)
+            remaining -= len(values)
+    return False, aug
+
+
+def read_chgcar(filename, read_diff=True, read_augmentation=False, dtype=np.float64, chunk_lines=65536):
+    """Read CHGCAR-like files (CHGCAR, ELFCAR, LOCPOT, ...) without pymatgen.
+    The grids are parsed with numpy directly into preallocated arrays,
+    the text is only ever held in chunks of chunk_lines lines.
+
+    Returns atoms, data, data_aug
+        data['total']: first grid (total density or spin up ELF)
+        data['diff']: second grid (magnetization or spin down ELF), the key
+                      only exists for spin polarized files and is None if
+                      read_diff is False (the block is not parsed then)
+        data_aug: None or, if read_augmentation, a dict with a list of
+                  augmentation occupancies per atom for each grid
+    """
+    with open(filename, 'rb') as f:
+        with stage('atoms'):
+            atoms, dim_tokens, shape = _read_header(f, filename)
+        data = {}
+        data_aug = {} if read_augmentation else None
+        with stage('parse'):
+            data['total'] = _read_grid(f, shape, dtype, chunk_lines)
+            spinpol, aug = _next_grid(f, dim_tokens, read_augmentation)
+        if read_augmentation:
+            data_aug['total'] = [np.array(a) for a in aug]
+        if spinpol:
+            if read_diff:
+                with stage('parse'):
+                    data['diff'] = _read_grid(f, shape, dtype, chunk_lines)
+                if read_augmentation:
+                    aug = _next_grid(f, dim_tokens, read_augmentation)[1]
+                    data_aug['diff'] = [np.array(a) for a in aug]
             else:
-                integral = np.sum(np.abs(full_chgcar.data['total']))
-                integral /= n_data
-            print("Integral of total data is {}".format(integral))
-            if spinpol:
-                if return_spin_integrals:
-                    spin_integral = spin_integrals[-1]
-                else:
-                    spin_integral = np.sum(np.abs(full_chgcar.data['diff']))
-                    spin_integral /= n_data
-                print("Integral of diff data is {}".format(spin_integral))
-
-            origin = np.zeros(3)
-            atoms = AseAtomsAdaptor.get_atoms(full_chgcar.structure)
-
-            #Contrary to VASP Wiki, the CHGCAR is not rho*V, but rho*n_data.
-            #So in order to have the integral over space = nelectrons, we need to divide by n_data.
-            #Since this would result in super small numbers, we can transform to rho*V
-            factor = n_data
-            if mult_volume:
-                factor /= atoms.get_volume()
-            full_chgcar.data['total'] /= factor
-            if spinpol: full_chgcar.data['diff'] /= factor
-            #write cube
-            filename = "{}.cube".format(outFiles[iFile])
-            if verbose: print("Writing {}".format(filename))
-            with open(filename, 'w') as f:
-                write_cube(f, atoms, data=full_chgcar.data['total'], origin=origin)
-            if spinpol:
-                filename = "{}_mag.cube".format(outFiles[iFile])
-                if verbose: print("Writing {}".format(filename))
-                with open(filename, 'w') as f:
-                    write_cube(f, atoms, data=full_chgcar.data['diff'], origin=origin)
-                
+                data['diff'] = None
+    return atoms, data, data_aug
+
+
+def read_grids(filename, read_diff=True, dtype=np.float64, cache=False, verbose=False):
+    """read_chgcar without augmentation, if cache use the on-disk grid cache (see gridcache.py).
+    Returns atoms and data.
+    """
+    if cache:
+        from gridcache import read_cached
+        return read_cached(filename, read_diff=read_diff, dtype=dtype, verbose=verbose)
+    return read_chgcar(filename, read_diff=read_diff, dtype=dtype)[:2]
+
+
+def open_output(filename):
+    """Open filename for writing text, compressed on the fly if it ends with .gz or .zst."""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'wt', compresslevel=6)
+    if filename.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Writing {} needs the zstandard package".format(filename))
+        return zstandard.open(filename, 'wt')
+    return open(filename, 'w')
+
+
+def write_sidecar(filename, atoms, data, origin, voxel):
+    """Store grid and atoms as binary .npz or .h5 (HDF5) file, units are Angstrom."""
+    arrays = {'data': data, 'cell': atoms.cell[:], 'positions': atoms.positions,
+              'numbers': atoms.numbers, 'origin': origin, 'voxel': voxel}
+    if filename.endswith('.h5'):
+        import h5py
+        with h5py.File(filename, 'w') as f:
+            for key, value in arrays.items():
+                f.create_dataset(key, data=value)
+    else:
+        np.savez(filename, **arrays)
+
+
+#peak memory of write_cube formatting a block of 2**20 values (Python floats and text)
+WRITE_BUFFER = 64 * 2**20
+
+
+def write_cube(filename, atoms, data, origin=None, voxel=None, precision=6, sidecar=None, comment=None, block_size=2**20):
+    """Write a Gaussian cube file, the grid is formatted in blocks of
+    about block_size values instead of value by value.
+    Same layout as ase.io.cube.write_cube (six values per line, new line
+    after each z-row) but with precision digits ('%.{precision}e').
+        filename: .gz or .zst endings are compressed on the fly
+        origin: origin of the grid in Angstrom
+        voxel: 3x3 voxel vectors in Angstrom, default: cell vectors / grid shape
+        sidecar: None, 'npz' or 'h5', additionally store grid and atoms as binary
+    """
+    if origin is None:
+        origin = np.zeros(3)
+    if voxel is None:
+        voxel = atoms.cell[:] / np.array(data.shape)[:, None]
+    if comment is None:
+        comment = 'Cube file from VASP-tools, written on ' + time.strftime('%c')
+
+    n1, n2, n3 = data.shape
+    value = ' %.{}e'.format(precision)
+    row = ''.join(value + ('\n' if k % 6 == 5 else '') for k in range(n3))
+    if n3 % 6:
+        row += '\n'
+    #whole x-slabs per block, the grids from read_chgcar are Fortran ordered
+    #and reshaping the full grid would copy it
+    slabs_per_block = max(1, block_size // (n2 * n3))
+
+    with open_output(filename) as f:
+        f.write(comment.strip())
+        f.write('\nOUTER LOOP: X, MIDDLE LOOP: Y, INNER LOOP: Z\n')
+        f.write('{:5}{:12.6f}{:12.6f}{:12.6f}\n'.format(len(atoms), *(np.asarray(origin) / Bohr)))
+        for n, v in zip(data.shape, voxel):
+            f.write('{:5}{:12.6f}{:12.6f}{:12.6f}\n'.format(n, *(v / Bohr)))
+        for Z, pos in zip(atoms.numbers, atoms.positions / Bohr):
+            f.write('{:5}{:12.6f}{:12.6f}{:12.6f}{:12.6f}\n'.format(Z, 0.0, *pos))
+        for start in range(0, n1, slabs_per_block):
+            block = data[start:start+slabs_per_block]
+            f.write((row * (len(block) * n2)) % tuple(block.ravel().tolist()))
+
+    if sidecar:
+        base = filename[:filename.rindex('.cube')] if '.cube' in filename else filename
+        write_sidecar('{}.{}'.format(base, sidecar), atoms, data, origin, voxel)
+
+
+def grid_selection(atoms, shape, stride=None, target_voxel_size=None, box=None, around_atoms=None, padding=2.0):
+    """Plan cropping and coarsening of a grid for the cube export.
+        stride: int or three ints, average blocks of stride points per direction
+        target_voxel_size: choose the stride to get voxels of about this length in Angstrom
+        box: crop to the Cartesian region xmin, ymin, zmin, xmax, ymax, zmax in Angstrom
+        around_atoms: crop to the box around the atoms with these indices plus padding (Angstrom)
+    Returns a dict with the grid indices per direction (wrapped periodically),
+    the stride and origin and voxel vectors of the new grid in Angstrom.
+    """
+    shape = np.array(shape)
+    voxel = atoms.cell[:] / shape[:, None]
+    if around_atoms is not None:
+        positions = atoms.positions[list(around_atoms)]
+        box = np.concatenate([positions.min(axis=0) - padding, positions.max(axis=0) + padding])
+    if box is not None:
+        lower, upper = np.reshape(box, (2, 3))
+        corners = np.array([[x, y, z] for x in (lower[0], upper[0]) for y in (lower[1], upper[1]) for z in (lower[2], upper[2])])
+        scaled = atoms.cell.scaled_positions(corners) * shape
+        start = np.floor(scaled.min(axis=0)).astype(int)
+        stop = np.minimum(np.ceil(scaled.max(axis=0)).astype(int) + 1, start + shape)
+    else:
+        start = np.zeros(3, dtype=int)
+        stop = shape
+
+    if target_voxel_size is not None:
+        stride = [max(1, int(round(target_voxel_size / np.linalg.norm(v)))) for v in voxel]
+    stride = np.ones(3, dtype=int) * (1 if stride is None else np.array(stride, dtype=int))
+    #blocks at the end are filled periodically
+    n_points = -(-(stop - start) // stride) * stride
+    indices = [np.arange(start[i], start[i] + n_points[i]) % shape[i] for i in range(3)]
+    #averaged values sit in the center of their block
+    origin = (start + (stride - 1) / 2) @ voxel
+    return {'indices': indices, 'stride': stride, 'origin': origin, 'voxel': voxel * stride[:, None]}
+
+
+def reduce_grid(grid, selection):
+    """Crop and block-average grid as planned by grid_selection, the full grid is returned as is."""
+    for axis in range(3):
+        indices = selection['indices'][axis]
+        if len(indices) != grid.shape[axis] or indices[0] != 0:
+            grid = np.take(grid, indices, axis=axis)
+        stride = selection['stride'][axis]
+        if stride > 1:
+            shape = list(grid.shape)
+            grid = grid.reshape(shape[:axis] + [shape[axis] // stride, stride] + shape[axis+1:]).mean(axis=axis+1)
+    return grid
+
+
+def add_cube_arguments(parser):
+    """Command line options of write_cube and grid_selection shared by the conversion scripts."""
+    parser.add_argument('--precision', help='Number of digits in the cube files', type=int, default=6)
+    parser.add_argument('--compress', help='Compress the cube files', choices=['gz', 'zst'], default=None)
+    parser.add_argument('--sidecar', help='Also store grids and atoms as binary file', choices=['npz', 'h5'], default=None)
+    parser.add_argument('--stride', help='Average blocks of N (or N1 N2 N3) grid points', type=int, nargs='+', default=None)
+    parser.add_argument('--target-voxel-size', help='Average blocks of grid points to get voxels of about this size in Angstrom', type=float, default=None)
+    parser.add_argument('--box', help='Only write the Cartesian region xmin ymin zmin xmax ymax zmax (Angstrom)', type=float, nargs=6, default=None)
+    parser.add_argument('--around-atoms', help='Only write the region around these atoms (indices starting at 0)', type=int, nargs='+', default=None)
+    parser.add_argument('--padding', help='Padding around --around-atoms in Angstrom', type=float, default=2.0)
+
+
+def grid_arguments(args):
+    """Keyword arguments for grid_selection from the parsed command line options."""
+    return {'stride': args.stride, 'target_voxel_size': args.target_voxel_size, 'box': args.box,
+            'around_atoms': args.around_atoms, 'padding': args.padding}
+
+
+def _convert(inFile, outFile, verbose, return_integrals, return_spin_integrals, mult_volume, magnetization, dtype, cache, extension, cube_options, grid_options):
+    """Convert a single file, returns the integral and spin integral (None if not requested)."""
+    with profile('chgcar2cube', inFile):
+        return _convert_file(inFile, outFile, verbose, return_integrals, return_spin_integrals, mult_volume, magnetization, dtype, cache, extension, cube_options, grid_options)
+
+
+def _convert_file(inFile, outFile, verbose, return_integrals, return_spin_integrals, mult_volume, magnetization, dtype, cache, extension, cube_options, grid_options):
+    if not os.path.isfile(inFile):
+        raise ValueError('File {:} does not exist'.format(inFile))
+
+    #if output exists mv to .bak
+    if os.path.isfile(outFile):
+        if verbose: print('ATTENTION: {:} exists, moving to *.bak'.format(outFile))
+        os.rename(outFile, outFile+'.bak')
+
+    if verbose: print("Reading {}".format(inFile))
+    atoms, data = read_grids(inFile, read_diff=magnetization or return_spin_integrals, dtype=dtype, cache=cache, verbose=verbose)
+    spinpol = 'diff' in data.keys()
+    if return_spin_integrals and not spinpol:
+        raise ValueError("File {} is not spinpolarized!".format(inFile))
+    shape = data['total'].shape
+    n_data = np.prod(shape)
+
+    integral = None
+    spin_integral = None
+    with stage('integrals'):
+        if return_integrals or verbose:
+            integral = _blockwise_statistics(data['total'])['abs_sum'] / n_data
+        if return_spin_integrals or (verbose and spinpol and data['diff'] is not None):
+            spin_integral = _blockwise_statistics(data['diff'])['abs_sum'] / n_data
+    if verbose:
+        print("Shape of data: {}".format(shape))
+        print("Total number of datapoints: {}".format(n_data))
+        print("Integral of total data is {}".format(integral))
+        if spin_integral is not None:
+            print("Integral of diff data is {}".format(spin_integral))
+
+    selection = grid_selection(atoms, shape, **grid_options)
+
+    #Contrary to VASP Wiki, the CHGCAR is not rho*V, but rho*n_data.
+    #So in order to have the integral over space = nelectrons, we need to divide by n_data.
+    #Since this would result in super small numbers, we can transform to rho*V
+    factor = n_data
+    if mult_volume:
+        factor /= atoms.get_volume()
+    with stage('convert'):
+        data['total'] /= factor
+        total = reduce_grid(data['total'], selection)
+    #write cube
+    filename = "{}{}".format(outFile, extension)
+    if verbose: print("Writing {}".format(filename))
+    with stage('write'):
+        write_cube(filename, atoms, total, origin=selection['origin'], voxel=selection['voxel'], **cube_options)
+    del total
+    if spinpol and magnetization:
+        with stage('convert'):
+            data['diff'] /= factor
+            diff = reduce_grid(data['diff'], selection)
+        filename = "{}_mag{}".format(outFile, extension)
+        if verbose: print("Writing {}".format(filename))
+        with stage('write'):
+            write_cube(filename, atoms, diff, origin=selection['origin'], voxel=selection['voxel'], **cube_options)
+    if verbose: print("Peak memory usage: {:.1f} MB".format(peak_memory()))
+    if not return_integrals:
+        integral = None
+    if not return_spin_integrals:
+        spin_integral = None
+    return integral, spin_integral
+
+
+def _accumulate(stats, block, scratch):
+    """Add block to the running statistics, scratch (same size as block, may be block itself) takes |block|."""
+    stats['sum'] += block.sum(dtype=np.float64)
+    stats['min'] = min(stats['min'], block.min())
+    stats['max'] = max(stats['max'], block.max())
+    stats['abs_sum'] += np.abs(block, out=scratch).sum(dtype=np.float64)
+    stats['n'] += len(block)
+
+
+def _blockwise_statistics(grid, block_size=2**20):
+    """Sum, |sum|, min and max of an in-memory or memory-mapped grid in blocks of block_size values."""
+    stats = {'sum': 0.0, 'abs_sum': 0.0, 'min': np.inf, 'max': -np.inf, 'n': 0}
+    #order='A' gives a view for the Fortran ordered grids
+    flat = grid.ravel(order='A')
+    scratch = np.empty(min(block_size, len(flat)), dtype=flat.dtype)
+    for start in range(0, len(flat), block_size):
+        block = flat[start:start+block_size]
+        _accumulate(stats, block, scratch[:len(block)])
+    return stats
+
+
+def grid_statistics(filename, read_diff=True, dtype=np.float64, cache=False, chunk_lines=65536):
+    """Integrals and statistics of a CHGCAR-like file without holding a full grid in memory.
+    The grids are either streamed from the text file chunk by chunk or,
+    if cache, read block-wise from the memory-mapped grids of gridcache.py.
+    Returns a dict with the shape and for 'total' and 'diff' (if spin
+    polarized and read_diff) sum, abs_sum, min, max and n, as well as
+        integral: abs_sum/n_data, the integral of chgcar2cube.main
+        electrons: sum/n_data of the total density
+        magnetization: sum/n_data of the magnetization density
+        up, down: number of electrons per spin
+    """
+    stats = {}
+    if cache:
+        atoms, data = read_grids(filename, read_diff=read_diff, dtype=dtype, cache=True)
+        stats['shape'] = data['total'].shape
+        for key, grid in data.items():
+            if grid is not None:
+                with stage('integrals'):
+                    stats[key] = _blockwise_statistics(grid)
+    else:
+        with open(filename, 'rb') as f:
+            with stage('atoms'):
+                atoms, dim_tokens, shape = _read_header(f, filename)
+            stats['shape'] = shape
+            key = 'total'
+            while True:
+                stats[key] = {'sum': 0.0, 'abs_sum': 0.0, 'min': np.inf, 'max': -np.inf, 'n': 0}
+                with stage('integrals'):
+                    for chunk in _iter_grid(f, int(np.prod(shape)), dtype, chunk_lines):
+                        #chunks are temporary, take the absolute values in place
+                        _accumulate(stats[key], chunk, chunk)
+                if key == 'diff' or not read_diff or not _next_grid(f, dim_tokens, False)[0]:
+                    break
+                key = 'diff'
+
+    n_data = np.prod(stats['shape'])
+    stats['total']['integral'] = stats['total']['abs_sum'] / n_data
+    stats['total']['electrons'] = stats['total']['sum'] / n_data
+    if 'diff' in stats:
+        stats['diff']['integral'] = stats['diff']['abs_sum'] / n_data
+        stats['diff']['magnetization'] = stats['diff']['sum'] / n_data
+        stats['up'] = (stats['total']['sum'] + stats['diff']['sum']) / (2 * n_data)
+        stats['down'] = (stats['total']['sum'] - stats['diff']['sum']) / (2 * n_data)
+    return stats
+
+
+def _integrate(inFile, return_spin_integrals, dtype, cache):
+    """Statistics of a single file, see grid_statistics."""
+    if not os.path.isfile(inFile):
+        raise ValueError('File {:} does not exist'.format(inFile))
+    with profile('chgcar2cube', inFile):
+        stats = grid_statistics(inFile, dtype=dtype, cache=cache)
+    if return_spin_integrals and 'diff' not in stats:
+        raise ValueError("File {} is not spinpolarized!".format(inFile))
+    return stats
+
+
+def print_statistics(inFile, stats):
+    total = stats['total']
+    print("{}: shape {}, electrons {:.6f}, integral {}, min {}, max {}".format(
+        inFile, stats['shape'], total['electrons'], total['integral'], total['min'], total['max']))
+    if 'diff' in stats:
+        diff = stats['diff']
+        print("{}: magnetization {:.6f}, integral of diff {}, min {}, max {}, up {:.6f}, down {:.6f}".format(
+            inFile, diff['magnetization'], diff['integral'], diff['min'], diff['max'], stats['up'], stats['down']))
+
+
+def main(inFiles, outFiles, verbose=True, return_integrals=False, return_spin_integrals=False, mult_volume=False, magnetization=True, dtype=np.float64, workers=1, precision=6, compress=None, sidecar=None, cache=False, integral_only=False, grid_options=None, return_failed=False):
+    """
+        magnetization: write the *_mag.cube for spin polarized files,
+                       if False the magnetization block is not even parsed
+        dtype: numpy dtype of the grids, np.float32 halves the memory footprint
+        workers: number of files converted in parallel, failed files do
+                 not abort the batch and get None as integral
+        precision: number of digits written to the cube files
+        compress: None, 'gz' or 'zst' to compress the cube files
+        sidecar: None, 'npz' or 'h5' to also write the grids as binary files
+        cache: keep the parsed grids in the on-disk cache of gridcache.py
+        grid_options: dict with keyword arguments of grid_selection to
+                      crop and coarsen the grids before writing
+        integral_only: only print and return the integrals and statistics
+                       computed block by block, no cube files are written
+                       and outFiles is ignored
+        return_failed: return the input files that failed instead of the integrals
+    """
+    if integral_only:
+        return_integrals = True
+        jobs = [(inFile, return_spin_integrals, dtype, cache) for inFile in inFiles]
+        results = []
+        batch, failed = run_batch(_integrate, jobs, workers=workers, verbose=verbose)
+        for inFile, stats in zip(inFiles, batch):
+            if stats is None:
+                results.append(None)
+                continue
+            print_statistics(inFile, stats)
+            results.append((stats['total']['integral'], stats['diff']['integral'] if return_spin_integrals else None))
+    else:
+        assert len(inFiles) == len(outFiles), "Number of input and output files must be equal!"
+        extension = '.cube.{}'.format(compress) if compress else '.cube'
+        cube_options = {'precision': precision, 'sidecar': sidecar}
+        jobs = [(inFile, outFiles[iFile], verbose, return_integrals, return_spin_integrals, mult_volume, magnetization, dtype, cache, extension, cube_options, grid_options or {})
+                for iFile,inFile in enumerate(inFiles)]
+        memory = None
+        if workers > 1:
+            memory = [estimate_memory(inFile, dtype, overhead=WRITE_BUFFER) if os.path.isfile(inFile) else 0 for inFile in inFiles]
+        results, failed = run_batch(_convert, jobs, workers=workers, verbose=verbose, memory=memory)
+    if return_failed:
+        return failed
+    results = [r if r is not None else (None, None) for r in results]
+    integrals = [r[0] for r in results]
+    spin_integrals = [r[1] for r in results]
+
     if return_integrals:
         if len(integrals) == 1:
             if return_spin_integrals: return integrals[0], spin_integrals[0]
@@ -92,12 +482,25 @@ def main(inFiles, outFiles, verbose=True, return_integrals=False, return_spin_in
 
 
 if __name__ == "__main__":
-    import argparse
+    import argparse, sys
     parser = argparse.ArgumentParser(description='Convert one or many CHGCAR-like files to cube format.')
     parser.add_argument('input', type=str, nargs='+', help='Input Files')
     parser.add_argument('-output', type=str, nargs='+', help='Output File Names (no extension)')
     parser.add_argument('-v', help='Verbose', action='store_true')
     parser.add_argument('--integral', help='Print Integrals', action='store_true')
+    parser.add_argument('--integral-only', help='Only print integrals and statistics, streams the grids and writes no cube files', action='store_true')
     parser.add_argument('--volume', help='Multiply the Density with the Cell Volume', action='store_true')
+    parser.add_argument('--nomag', help='Do not read the magnetization density or write *_mag.cube', action='store_true')
+    parser.add_argument('--float32', help='Keep the grids in single precision to save memory', action='store_true')
+    parser.add_argument('--jobs', help='Number of files to convert in parallel', type=int, default=1)
+    add_cube_arguments(parser)
+    parser.add_argument('--cache', help='Reuse parsed grids from the cache (see gridcache.py)', action='store_true')
+    add_profile_arguments(parser)
     args = parser.parse_args()
-    main(args.input, args.output, verbose=args.v, return_integrals=args.integral, mult_volume=args.volume)
+    setup(args)
+    failed = main(args.input, args.output, verbose=args.v, return_integrals=args.integral, mult_volume=args.volume,
+                  magnetization=not args.nomag, dtype=np.float32 if args.float32 else np.float64, workers=args.jobs,
+                  precision=args.precision, compress=args.compress, sidecar=args.sidecar, cache=args.cache, integral_only=args.integral_only,
+                  grid_options=grid_arguments(args), return_failed=True)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+#
+# Script to calculate the deformation density AB-(A+B) from three CHGCARs
+# and write it as cube files in e-/Ang^3 (or e- with --volume).
+#
+# You can import the module and then call .main() or use it as a script
+from chgcar2cube import add_cube_arguments, read_grids, write_cube
+import numpy as np
+import os
+
+
+def check_compatible(atoms, data, refAtoms, refData, name):
+    """Raise a ValueError if grid or cell do not match the reference."""
+    if data['total'].shape != refData['total'].shape:
+        raise ValueError("Grid of {} {} does not match {}".format(name, data['total'].shape, refData['total'].shape))
+    if not np.allclose(atoms.cell[:], refAtoms.cell[:], atol=1e-4):
+        raise ValueError("Cell of {} does not match".format(name))
+
+
+def main(dirAB, dirA, dirB, outFile='deformation_density', mult_volume=True, magnetization=True, dtype=np.float64,
+         cache=True, verbose=True, precision=6, compress=None, sidecar=None):
+    """
+        dirAB, dirA, dirB: folders containing the CHGCARs of AB, A and B
+        outFile: output file name (no extension), writes outFile.cube and outFile_mag.cube
+        mult_volume: multiply the density with the cell volume like chgcar2cube --volume
+        magnetization: also calculate the magnetization deformation density if spin polarized
+        cache: keep the parsed grids in the on-disk cache of gridcache.py
+    """
+    names = ['AB', 'A', 'B']
+    chgcars = [os.path.join(d, 'CHGCAR') for d in (dirAB, dirA, dirB)]
+    for chgcar in chgcars:
+        if not os.path.isfile(chgcar):
+            raise ValueError('File {:} does not exist'.format(chgcar))
+
+    #AB-(A+B), keep only the AB grids and the result in memory
+    if verbose: print("Reading {}".format(chgcars[0]))
+    atoms, deformation = read_grids(chgcars[0], read_diff=magnetization, dtype=dtype, cache=cache, verbose=verbose)
+    for name, chgcar in zip(names[1:], chgcars[1:]):
+        if verbose: print("Reading {}".format(chgcar))
+        fragAtoms, data = read_grids(chgcar, read_diff=magnetization, dtype=dtype, cache=cache, verbose=verbose)
+        check_compatible(fragAtoms, data, atoms, deformation, name)
+        deformation['total'] -= data['total']
+        if magnetization and 'diff' in deformation and 'diff' in data:
+            deformation['diff'] -= data['diff']
+        else:
+            deformation.pop('diff', None)
+        del data
+
+    #see chgcar2cube for the units
+    factor = np.prod(deformation['total'].shape)
+    if mult_volume:
+        factor /= atoms.get_volume()
+    extension = '.cube.{}'.format(compress) if compress else '.cube'
+    cube_options = {'precision': precision, 'sidecar': sidecar}
+
+    if verbose: print("Calculating Total Deformation Density.")
+    deformation['total'] /= factor
+    filename = "{}{}".format(outFile, extension)
+    if verbose: print("Writing {}".format(filename))
+    write_cube(filename, atoms, deformation['total'], **cube_options)
+    if 'diff' in deformation:
+        if verbose: print("Calculating Magnetization Deformation Density.")
+        deformation['diff'] /= factor
+        filename = "{}_mag{}".format(outFile, extension)
+        if verbose: print("Writing {}".format(filename))
+        write_cube(filename, atoms, deformation['diff'], **cube_options)
+    return
+
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Calculate the deformation density AB-(A+B) from three CHGCARs.')
+    parser.add_argument('AB', type=str, help='Folder of the combined system')
+    parser.add_argument('A', type=str, help='Folder of fragment A')
+    parser.add_argument('B', type=str, help='Folder of fragment B')
+    parser.add_argument('-o', type=str, help='Output File Name (no extension)', default='deformation_density')
+    parser.add_argument('-v', help='Verbose', action='store_true')
+    parser.add_argument('--novolume', help='Do not multiply the Density with the Cell Volume', action='store_true')
+    parser.add_argument('--nomag', help='Do not calculate the magnetization deformation density', action='store_true')
+    parser.add_argument('--nocache', help='Do not use the grid cache (see gridcache.py)', action='store_true')
+    parser.add_argument('--float32', help='Keep the grids in single precision to save memory', action='store_true')
+    add_cube_arguments(parser)
+    args = parser.parse_args()
+    main(args.AB, args.A, args.B, outFile=args.o, mult_volume=not args.novolume, magnetization=not args.nomag,
+         dtype=np.float32 if args.float32 else np.float64, cache=not args.nocache, verbose=args.v,
+         precision=args.precision, compress=args.compress, sidecar=args.sidecar)
@@ -5,83 +5,113 @@
 # 2022/04/04
 #
 # You can import the module and then call .main() or use it as a script
-from curses import has_key
-from pymatgen.io.vasp.outputs import Elfcar
-from pymatgen.io.ase import AseAtomsAdaptor
-from ase.io.cube import write_cube
+from batch import estimate_memory, run_batch
+from chgcar2cube import WRITE_BUFFER, add_cube_arguments, grid_arguments, grid_selection, read_grids, reduce_grid, write_cube
+from profiling import add_profile_arguments, profile, setup, stage
 import numpy as np
 import os
 
 
-def main(inFiles, outFiles, verbose=True, return_integrals=False, return_spin_integrals=False):
-    assert len(inFiles) == len(outFiles), "Number of input and output files must be equal!"
-    integrals = []
-    spin_integrals = []
-    for iFile,inFile in enumerate(inFiles):
-        if not os.path.isfile(inFile):
-            raise ValueError('File {:} does not exist'.format(inFile))
-
-        #if output exists mv to .bak
-        if os.path.isfile(outFiles[iFile]):
-            if verbose: print('ATTENTION: {:} exists, moving to *.bak'.format(outFiles[iFile]))
-            os.rename(outFiles[iFile], outFiles[iFile]+'.bak')
-
-        if verbose: print("Reading {}".format(inFile))
-        full_elfcar = Elfcar.from_file(inFile)
-        spinpol = 'diff' in full_elfcar.data.keys()
-        #pymatgen: “total” key refers to Spin.up, and “diff” refers to Spin.down.
-        if return_spin_integrals and not spinpol:
-            raise ValueError("File {} is not spinpolarized!".format(inFile))
-        shape = full_elfcar.data['total'].shape
-        n_data = np.prod(shape)
+def _convert(inFile, outFile, verbose, return_integrals, return_spin_integrals, cache, extension, cube_options, grid_options):
+    """Convert a single file, returns the integral and spin integrals (None if not requested)."""
+    with profile('elf2cube', inFile):
+        return _convert_file(inFile, outFile, verbose, return_integrals, return_spin_integrals, cache, extension, cube_options, grid_options)
+
+
+def _convert_file(inFile, outFile, verbose, return_integrals, return_spin_integrals, cache, extension, cube_options, grid_options):
+    if not os.path.isfile(inFile):
+        raise ValueError('File {:} does not exist'.format(inFile))
+
+    #if output exists mv to .bak
+    if os.path.isfile(outFile):
+        if verbose: print('ATTENTION: {:} exists, moving to *.bak'.format(outFile))
+        os.rename(outFile, outFile+'.bak')
+
+    if verbose: print("Reading {}".format(inFile))
+    atoms, elf = read_grids(inFile, cache=cache, verbose=verbose)
+    spinpol = 'diff' in elf.keys()
+    #“total” key refers to Spin.up, and “diff” refers to Spin.down.
+    if return_spin_integrals and not spinpol:
+        raise ValueError("File {} is not spinpolarized!".format(inFile))
+    shape = elf['total'].shape
+    n_data = np.prod(shape)
 
+    with stage('convert'):
         if spinpol:
-            full_data = full_elfcar.data['total'] + full_elfcar.data['diff']
+            full_data = elf['total'] + elf['diff']
         else:
-            full_data = full_elfcar.data['total']
-        
+            full_data = elf['total']
+
+    integral = None
+    spin_integral = None
+    with stage('integrals'):
         if return_integrals:
-            integrals.append(np.sum(np.abs(full_data)))
+            integral = np.sum(np.abs(full_data))
         if return_spin_integrals:
-            spin_integrals.append((np.sum(np.abs(full_elfcar.data['total'])), np.sum(np.abs(full_elfcar.data['diff']))))
-        if verbose:
-            print("Shape of data: {}".format(shape))
-            print("Total number of datapoints: {}".format(n_data))
-            if return_integrals:
-                integral = integrals[-1]
-            else:
-                integral = np.sum(np.abs(full_data))
+            spin_integral = (np.sum(np.abs(elf['total'])), np.sum(np.abs(elf['diff'])))
+    if verbose:
+        print("Shape of data: {}".format(shape))
+        print("Total number of datapoints: {}".format(n_data))
+        if return_integrals:
             print("Integral of total data is {}".format(integral))
-            if spinpol:
-                if return_spin_integrals:
-                    spin_integral = spin_integrals[-1]
-                else:
-                    spin_integral = (np.sum(np.abs(full_elfcar.data['total'])), np.sum(np.abs(full_elfcar.data['diff'])))
+        else:
+            print("Integral of total data is {}".format(np.sum(np.abs(full_data))))
+        if spinpol:
+            if return_spin_integrals:
                 print("Integral of spin data is up: {}, down: {}".format(*spin_integral))
-
-            origin = np.zeros(3)
-            atoms = AseAtomsAdaptor.get_atoms(full_elfcar.structure)
-
-            #write cubes
-            if spinpol:
-                filename = "{}_up.cube".format(outFiles[iFile])
-                if verbose: print("Writing {}".format(filename))
-                with open(filename, 'w') as f:
-                    write_cube(f, atoms, data=full_elfcar.data['total'], origin=origin)
-                filename = "{}_down.cube".format(outFiles[iFile])
-                if verbose: print("Writing {}".format(filename))
-                with open(filename, 'w') as f:
-                    write_cube(f, atoms, data=full_elfcar.data['diff'], origin=origin)
-                filename = "{}_diff.cube".format(outFiles[iFile])
-                if verbose: print("Writing {}".format(filename))
-                with open(filename, 'w') as f:
-                    write_cube(f, atoms, data=full_elfcar.data['total']-full_elfcar.data['diff'], origin=origin)
             else:
-                filename = "{}.cube".format(outFiles[iFile])
-                if verbose: print("Writing {}".format(filename))
-                with open(filename, 'w') as f:
-                    write_cube(f, atoms, data=full_data, origin=origin)
-                
+                print("Integral of spin data is up: {}, down: {}".format(np.sum(np.abs(elf['total'])), np.sum(np.abs(elf['diff']))))
+
+    selection = grid_selection(atoms, shape, **grid_options)
+    cube_options = dict(cube_options, origin=selection['origin'], voxel=selection['voxel'])
+
+    #write cubes
+    if spinpol:
+        grids = [('_up', lambda: elf['total']), ('_down', lambda: elf['diff']), ('_diff', lambda: elf['total']-elf['diff'])]
+    else:
+        grids = [('', lambda: full_data)]
+    for suffix, grid in grids:
+        filename = "{}{}{}".format(outFile, suffix, extension)
+        with stage('convert'):
+            grid = reduce_grid(grid(), selection)
+        if verbose: print("Writing {}".format(filename))
+        with stage('write'):
+            write_cube(filename, atoms, grid, **cube_options)
+        del grid
+    return integral, spin_integral
+
+
+def main(inFiles, outFiles, verbose=True, return_integrals=False, return_spin_integrals=False, workers=1, precision=6, compress=None, sidecar=None, cache=False, grid_options=None, return_failed=False):
+    """
+        workers: number of files converted in parallel, failed files do
+                 not abort the batch and get None as integral
+        precision: number of digits written to the cube files
+        compress: None, 'gz' or 'zst' to compress the cube files
+        sidecar: None, 'npz' or 'h5' to also write the grids as binary files
+        cache: keep the parsed grids in the on-disk cache of gridcache.py
+        grid_options: dict with keyword arguments of chgcar2cube.grid_selection
+                      to crop and coarsen the grids before writing
+        return_failed: return the input files that failed instead of the integrals
+    """
+    assert len(inFiles) == len(outFiles), "Number of input and output files must be equal!"
+    extension = '.cube.{}'.format(compress) if compress else '.cube'
+    cube_options = {'precision': precision, 'sidecar': sidecar}
+    jobs = [(inFile, outFiles[iFile], verbose, return_integrals, return_spin_integrals, cache, extension, cube_options, grid_options or {})
+            for iFile,inFile in enumerate(inFiles)]
+    memory = None
+    if workers > 1:
+        #ELFCAR: ' 0.12345E+00' = 12 characters per value. Spin polarized files hold two grids and
+        #up to four are in memory (up, down, their sum and np.abs() of it or their difference),
+        #unpolarized ones hold one and need up to two: twice the values of the file plus the
+        #block buffer of write_cube in both cases
+        memory = [estimate_memory(inFile, chars_per_value=12, n_copies=2, overhead=WRITE_BUFFER) if os.path.isfile(inFile) else 0 for inFile in inFiles]
+    results, failed = run_batch(_convert, jobs, workers=workers, verbose=verbose, memory=memory)
+    if return_failed:
+        return failed
+    results = [r if r is not None else (None, None) for r in results]
+    integrals = [r[0] for r in results]
+    spin_integrals = [r[1] for r in results]
+
     if return_integrals:
         if len(integrals) == 1:
             if return_spin_integrals: return integrals[0], spin_integrals[0]
@@ -95,10 +125,19 @@ def main(inFiles, outFiles, verbose=True, return_integrals=False, return_spin_in
 
 
 if __name__ == "__main__":
-    import argparse
+    import argparse, sys
     parser = argparse.ArgumentParser(description='Convert one or many ELFCAR files to cube format.')
     parser.add_argument('input', type=str, nargs='+', help='Input Files')
     parser.add_argument('-output', type=str, nargs='+', help='Output File Names (no extension)')
     parser.add_argument('-v', help='Verbose', action='store_true')
+    parser.add_argument('--jobs', help='Number of files to convert in parallel', type=int, default=1)
+    add_cube_arguments(parser)
+    parser.add_argument('--cache', help='Reuse parsed grids from the cache (see gridcache.py)', action='store_true')
+    add_profile_arguments(parser)
     args = parser.parse_args()
-    main(args.input, args.output, verbose=args.v)
\ No newline at end of file
+    setup(args)
+    failed = main(args.input, args.output, verbose=args.v, workers=args.jobs,
+                  precision=args.precision, compress=args.compress, sidecar=args.sidecar, cache=args.cache, grid_options=grid_arguments(args),
+                  return_failed=True)
+    if failed:
+        sys.exit(1)
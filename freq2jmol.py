@@ -1,16 +1,130 @@
 #!/usr/bin/env python3
-from ase.calculators.vasp import Vasp
+#
+# Script to write the vibrations of a VASP frequency calculation as jmol file
+# and as ext-xyz animations of the modes (vib-NNN.xyz or one file for all modes)
+#
+# You can import the module and call the functions or use it as a script
+from ase import units
+from batch import run_batch
+import numpy as np
 import os
-os.environ['VASP_PP_PATH'] = "/home/patrickm/lib/vasp/ase"
-
-calc = Vasp(restart=True, directory='./')
-vibs = calc.get_vibrations()
-vibs.write_jmol()
-
-energies = vibs.get_energies()
-nVibs = len(energies)
-for i in range(nVibs):
-    with open("vib-{:03d}.xyz".format(i+1), 'w') as f:
-        for frame in vibs.iter_animated_mode(i):
-            frame.write(f, format='extxyz')
-    print("Frequency #{:03d}: {:10.6f} cm-1".format(i+1, energies[i]))
+
+
+def signed_frequencies(vibs):
+    """Frequencies in cm-1, imaginary ones as negative numbers."""
+    frequencies = np.asarray(vibs.get_frequencies())
+    return np.where(np.abs(frequencies.imag) > np.abs(frequencies.real), -np.abs(frequencies.imag), frequencies.real)
+
+
+def select_modes(frequencies, spec='all'):
+    """Indices of the modes selected by spec:
+        all, imaginary or real
+        lower:upper   frequency range in cm-1 (imaginary ones are negative), one side may be empty
+        1,3,5-8       mode numbers starting at 1
+    """
+    frequencies = np.asarray(frequencies)
+    indices = np.arange(len(frequencies))
+    if spec == 'all':
+        return indices
+    if spec == 'imaginary':
+        return indices[frequencies < 0]
+    if spec == 'real':
+        return indices[frequencies >= 0]
+    if ':' in spec:
+        lower, upper = spec.split(':')
+        lower = float(lower) if lower else -np.inf
+        upper = float(upper) if upper else np.inf
+        return indices[(frequencies >= lower) & (frequencies <= upper)]
+    selected = []
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            selected.extend(range(int(first), int(last) + 1))
+        else:
+            selected.append(int(part))
+    selected = np.array(selected) - 1
+    if selected.min() < 0 or selected.max() >= len(frequencies):
+        raise ValueError("Mode numbers must be between 1 and {}".format(len(frequencies)))
+    return selected
+
+
+def animate_mode(positions, mode, energy, temperature=units.kB * 300.0, frames=30):
+    """Positions of all frames of a mode animation like VibrationsData.iter_animated_mode,
+    as one array of shape (frames, nAtoms, 3).
+    """
+    amplitude = mode * np.sqrt(temperature / abs(energy))
+    phase = np.sin(np.linspace(0, 2 * np.pi, frames, endpoint=False))
+    return positions + phase[:, None, None] * amplitude
+
+
+def format_frames(symbols, frames, comment):
+    """ext-xyz text of all frames (array of shape (frames, nAtoms, 3)), one string formatting per frame."""
+    template = "{}\n{}\n".format(len(symbols), comment) + \
+               "\n".join("{:<2s} %16.8f %16.8f %16.8f".format(s) for s in symbols) + "\n"
+    return "".join(template % tuple(frame.ravel()) for frame in frames)
+
+
+def comment(atoms, index, frequency):
+    lattice = " ".join("{}".format(x) for x in atoms.cell[:].ravel())
+    pbc = " ".join('T' if p else 'F' for p in atoms.pbc)
+    return 'Lattice="{}" Properties=species:S:1:pos:R:3 mode={} frequency={:.6f} pbc="{}"'.format(lattice, index + 1, frequency, pbc)
+
+
+def write_modes(filename, atoms, modes, energies, frequencies, numbers, frames=30, append=False):
+    """Write the animations of modes (with energies, frequencies and the indices numbers of these modes) into filename."""
+    symbols = atoms.get_chemical_symbols()
+    with open(filename, 'a' if append else 'w') as f:
+        for mode, energy, frequency, i in zip(modes, energies, frequencies, numbers):
+            positions = animate_mode(atoms.positions, mode, energy, frames=frames)
+            f.write(format_frames(symbols, positions, comment(atoms, i, frequency)))
+
+
+def write_mode_files(numbers, atoms, modes, energies, frequencies, frames=30):
+    """Like write_modes but every mode into its own vib-NNN.xyz."""
+    for mode, energy, frequency, i in zip(modes, energies, frequencies, numbers):
+        write_modes("vib-{:03d}.xyz".format(i+1), atoms, [mode], [energy], [frequency], [i], frames)
+
+
+def main(modes='all', single=None, frames=30, workers=1, jmol=True):
+    """
+        modes: selection of modes, see select_modes
+        single: write all selected modes into this file instead of one vib-NNN.xyz per mode
+        frames: number of frames per mode
+        workers: number of processes writing the vib-NNN.xyz files
+        jmol: also write the jmol file of all vibrations
+    """
+    from ase.calculators.vasp import Vasp
+    calc = Vasp(restart=True, directory='./')
+    vibs = calc.get_vibrations()
+    if jmol:
+        vibs.write_jmol()
+
+    atoms = vibs.get_atoms()
+    allModes = vibs.get_modes(all_atoms=True)
+    energies = vibs.get_energies()
+    frequencies = signed_frequencies(vibs)
+    indices = select_modes(frequencies, modes)
+    for i in indices:
+        print("Frequency #{:03d}: {:10.4f} cm-1".format(i+1, frequencies[i]))
+
+    if single:
+        write_modes(single, atoms, allModes[indices], energies[indices], frequencies[indices], indices, frames)
+    elif len(indices):
+        #every worker writes the files of a chunk of modes
+        chunks = [c for c in np.array_split(indices, max(1, workers)) if len(c)]
+        run_batch(write_mode_files, [(c, atoms, allModes[c], energies[c], frequencies[c], frames) for c in chunks], workers=workers)
+    return
+
+
+
+if __name__ == "__main__":
+    import argparse
+    os.environ['VASP_PP_PATH'] = "/home/patrickm/lib/vasp/ase"
+    parser = argparse.ArgumentParser(description='Write the vibrations of a VASP frequency calculation as jmol and ext-xyz animations')
+    parser.add_argument('--modes', type=str, help='Modes to animate: all, imaginary, real, a frequency range lower:upper in cm-1 or mode numbers like 1,3,5-8', default='all')
+    parser.add_argument('--single', type=str, help='Write all selected modes into this file instead of vib-NNN.xyz', default=None)
+    parser.add_argument('--frames', type=int, help='Frames per mode', default=30)
+    parser.add_argument('--jobs', type=int, help='Number of processes writing the vib-NNN.xyz files', default=1)
+    parser.add_argument('--nojmol', help='Do not write the jmol file', action='store_true')
+    args = parser.parse_args()
+    main(args.modes, args.single, args.frames, args.jobs, not args.nojmol)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+#
+# On-disk cache of parsed CHGCAR-like grids (CHGCAR, ELFCAR, ...)
+#
+# The grids are stored as .npy files and opened as memory maps, so a repeated
+# conversion costs a memmap open instead of parsing the text file again.
+# Entries are identified by the content hash of the input file, a small index
+# per input path (path, size, mtime) avoids rehashing unchanged files.
+# The least recently used entries are removed once the cache exceeds its size.
+#
+# Location and size can be set with VASPTOOLS_CACHE (default ~/.cache/vasp-tools)
+# and VASPTOOLS_CACHE_SIZE (in GB, default 20).
+#
+# You can import the module and then call .read_cached() or use it as a script
+from ase import Atoms
+from chgcar2cube import read_chgcar
+from profiling import stage
+import numpy as np
+import hashlib, json, os, shutil, tempfile
+
+
+def cache_dir():
+    """Cache location, VASPTOOLS_CACHE or ~/.cache/vasp-tools."""
+    return os.environ.get('VASPTOOLS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'vasp-tools'))
+
+
+def cache_size():
+    """Maximum cache size in bytes, VASPTOOLS_CACHE_SIZE in GB or 20 GB."""
+    return int(float(os.environ.get('VASPTOOLS_CACHE_SIZE', 20)) * 1024**3)
+
+
+def file_hash(filename, blocksize=2**24):
+    """blake2b hash of the content of filename."""
+    h = hashlib.blake2b(digest_size=20)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _write_json(filename, content):
+    """Write json atomically, parallel workers might access the same files."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmp, filename)
+
+
+def _read_json(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def lookup(filename, root=None):
+    """Return the content hash of filename, reusing the stored one if path, size and mtime did not change."""
+    root = root or cache_dir()
+    path = os.path.realpath(filename)
+    stat = os.stat(path)
+    pathsDir = os.path.join(root, 'paths')
+    os.makedirs(pathsDir, exist_ok=True)
+    indexFile = os.path.join(pathsDir, hashlib.sha1(path.encode()).hexdigest() + '.json')
+    index = _read_json(indexFile)
+    if index and index['path'] == path and index['size'] == stat.st_size and index['mtime'] == stat.st_mtime_ns:
+        return index['hash']
+    content = file_hash(path)
+    _write_json(indexFile, {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': content})
+    return content
+
+
+def _grid_file(entry, key, dtype):
+    return os.path.join(entry, '{}_{}.npy'.format(key, np.dtype(dtype).name))
+
+
+def _load(entry, meta, read_diff, dtype):
+    """Open the grids of a cache entry as copy-on-write memory maps, None if grids are missing."""
+    keys = ['total']
+    if meta['spinpol'] and read_diff:
+        keys.append('diff')
+    if not all(os.path.isfile(_grid_file(entry, key, dtype)) for key in keys):
+        return None
+    atoms = Atoms(numbers=meta['numbers'], positions=meta['positions'], cell=meta['cell'], pbc=True)
+    data = {key: np.load(_grid_file(entry, key, dtype), mmap_mode='c') for key in keys}
+    if meta['spinpol'] and not read_diff:
+        data['diff'] = None
+    #mark as recently used
+    os.utime(os.path.join(entry, 'meta.json'))
+    return atoms, data
+
+
+def _store(entry, atoms, data, dtype):
+    os.makedirs(entry, exist_ok=True)
+    for key, grid in data.items():
+        if grid is None:
+            continue
+        filename = _grid_file(entry, key, dtype)
+        fd, tmp = tempfile.mkstemp(dir=entry, suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, grid)
+        os.replace(tmp, filename)
+    size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry) if f.endswith('.npy'))
+    _write_json(os.path.join(entry, 'meta.json'), {
+        'numbers': atoms.numbers.tolist(), 'positions': atoms.positions.tolist(),
+        'cell': atoms.cell[:].tolist(), 'shape': list(data['total'].shape),
+        'spinpol': 'diff' in data, 'bytes': size})
+
+
+def evict(root=None, max_size=None):
+    """Remove the least recently used entries until the cache is smaller than max_size bytes."""
+    root = root or cache_dir()
+    max_size = cache_size() if max_size is None else max_size
+    gridsDir = os.path.join(root, 'grids')
+    if not os.path.isdir(gridsDir):
+        return
+    entries = []
+    for name in os.listdir(gridsDir):
+        metaFile = os.path.join(gridsDir, name, 'meta.json')
+        meta = _read_json(metaFile)
+        if meta is None:
+            continue
+        entries.append((os.path.getmtime(metaFile), meta['bytes'], os.path.join(gridsDir, name)))
+    total = sum(e[1] for e in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_size:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def read_cached(filename, read_diff=True, dtype=np.float64, root=None, max_size=None, verbose=False):
+    """Like chgcar2cube.read_chgcar but the grids come from the cache if possible.
+    The grids are copy-on-write memory maps, changing them does not alter the cache.
+    Returns atoms and data.
+    """
+    root = root or cache_dir()
+    entry = os.path.join(root, 'grids', lookup(filename, root))
+    meta = _read_json(os.path.join(entry, 'meta.json'))
+    if meta:
+        with stage('cache'):
+            cached = _load(entry, meta, read_diff, dtype)
+        if cached:
+            if verbose: print("Using cached grids of {} from {}".format(filename, entry))
+            return cached
+
+    atoms, data, _ = read_chgcar(filename, read_diff=read_diff, dtype=dtype)
+    if verbose: print("Caching grids of {} in {}".format(filename, entry))
+    with stage('cache'):
+        _store(entry, atoms, data, dtype)
+    evict(root, max_size)
+    return atoms, data
+
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Manage the cache of parsed CHGCAR-like grids.')
+    parser.add_argument('input', type=str, nargs='*', help='Files to add to the cache')
+    parser.add_argument('--clear', help='Remove all cached grids', action='store_true')
+    parser.add_argument('--evict', help='Shrink the cache to VASPTOOLS_CACHE_SIZE', action='store_true')
+    args = parser.parse_args()
+    if args.clear:
+        evict(max_size=0)
+    if args.evict:
+        evict()
+    for inFile in args.input:
+        read_cached(inFile, verbose=True)
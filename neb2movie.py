@@ -5,12 +5,31 @@
 #
 # You can import the module and then call .main() or use it as a script
 from ase import io
+from concurrent.futures import ThreadPoolExecutor
+from outcarscan import last_geometry
+from vasp2traj import write_frames
 import os, glob
 
-def main(outFile='movie.xyz', workdir='.', wrap='False', use=None):
+
+def load_image(imagePath, outcar=None, wrap=False):
+    """Read one NEB image, with outcar the geometry is taken from the end of that OUTCAR."""
+    atoms = io.read(imagePath, format='vasp')
+    if outcar:
+        atoms = last_geometry(outcar, atoms)
+    if wrap:
+        atoms.wrap(center=(0.0,0.0,0.0))
+    return atoms
+
+
+def main(outFile='movie.xyz', workdir='.', wrap='False', use=None, format=None, from_outcar=False, workers=8):
     """
         use: None -> Auto use CONTCAR if available, otherwise POSCAR
              CONTCAR or POSCAR
+        format: 'extxyz', 'traj' or 'h5', see vasp2traj.write_frames,
+                None: guess from outFile
+        from_outcar: take the last geometry of the OUTCAR of each intermediate image
+                     (e.g. if the CONTCARs are outdated)
+        workers: number of images read in parallel
     """
 
     #if output exists mv to .bak
@@ -20,6 +39,8 @@ def main(outFile='movie.xyz', workdir='.', wrap='False', use=None):
 
     if use:
         filename = use
+    elif from_outcar:
+        filename = 'POSCAR'
     else:
         if os.path.isfile(os.path.join(workdir,'01','CONTCAR')):
             filename = 'CONTCAR'
@@ -28,30 +49,38 @@ def main(outFile='movie.xyz', workdir='.', wrap='False', use=None):
         else:
             raise RuntimeError("Could neither find CONTCAR nor POSCAR in {:}".format(os.path.join(workdir,'01')))
         print("Using {:} files.".format(filename))
-    mol = []
     dirs = glob.glob(os.path.join(workdir,'[0-9][0-9]'))
     dirs.sort()
     print("Found {:} NEB subdirs.".format(len(dirs)))
-    print("Loading images ", end='')
+    jobs = []
     for i,image in enumerate(dirs):
+        outcar = None
         if (i == 0) or (i == len(dirs)-1):
             imagePath = os.path.join(image, 'POSCAR')
         else:
             imagePath = os.path.join(image,filename)
+            if from_outcar:
+                outcar = os.path.join(image, 'OUTCAR')
+                if not os.path.isfile(outcar):
+                    raise RuntimeError('File {:} does not exist'.format(str(outcar)))
         if not os.path.isfile(imagePath):
             raise RuntimeError('File {:} does not exist'.format(str(imagePath)))
+        jobs.append((imagePath, outcar))
 
-        print(" {:}".format(os.path.split(image)[-1]), end='')
-        mol.append(io.read(imagePath, format='vasp'))
-
+    #the images are loaded in parallel but written in order as they arrive
+    print("Loading images ", end='')
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        mol = pool.map(lambda job: load_image(*job, wrap=wrap), jobs)
+        write_frames(outFile, _report(mol, dirs), format=format)
     print("")
-    for frame in mol:
-        if wrap:
-            frame.wrap(center=(0.0,0.0,0.0))
-        frame.write(outFile,append=True)
     return
 
 
+def _report(frames, dirs):
+    for frame, image in zip(frames, dirs):
+        print(" {:}".format(os.path.split(image)[-1]), end='', flush=True)
+        yield frame
+
 
 if __name__ == "__main__":
     import argparse
@@ -59,6 +88,9 @@ if __name__ == "__main__":
     parser.add_argument('-o', type=str, help='Output xyz file', default='movie.xyz')
     parser.add_argument('-i', type=str, help='Workdir', default='.')
     parser.add_argument('-w', help='Wrap structure with origin as center', action='store_const', default=False, const=True)
+    parser.add_argument('--format', help='Output format, default: guess from the output file (*.traj, *.h5, otherwise extxyz)', choices=['extxyz', 'traj', 'h5'], default=None)
+    parser.add_argument('--from-outcar', help='Use the last geometry of the OUTCARs of the intermediate images', action='store_true')
+    parser.add_argument('--jobs', help='Number of images to read in parallel', type=int, default=8)
     parser.add_argument('use', type=str, help='Use 1: CONTCAR or 0: POSCAR, default: Auto choose CONTCAR over POSCAR.', nargs='?')
     args = parser.parse_args()
     if args.use == "1":
@@ -67,6 +99,6 @@ if __name__ == "__main__":
         use = 'POSCAR'
     else:
         use = None
-    main(args.o, args.i, args.w, use)
+    main(args.o, args.i, args.w, use, format=args.format, from_outcar=args.from_outcar, workers=args.jobs)
 
 
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+#
+# Script to collect the barriers of many VTST NEB calculations in one table
+#
+# Walks a directory tree for NEB folders (00, 01, ... subfolders and neb.dat/spline.dat
+# of nebresults.pl), processes them in parallel and writes one CSV (or Parquet) table.
+# The results are cached in .nebsurvey.json in every NEB folder, unchanged NEBs
+# are skipped on the next run.
+#
+# You can import the module and then call .main() or use it as a script
+from batch import run_batch
+from outcarscan import scan_outcars
+import plotNEB, neb2movie
+import numpy as np
+import csv, glob, json, os
+
+COLUMNS = ['path', 'images', 'forward_barrier', 'reverse_barrier', 'highest_image', 'max_force', 'dispersion', 'unit', 'error']
+CACHE = '.nebsurvey.json'
+
+
+def is_neb(path):
+    """True if path contains the 00 image folder and the neb.dat/spline.dat of nebresults.pl."""
+    return all(os.path.exists(os.path.join(path, f)) for f in ('00', 'neb.dat', 'spline.dat'))
+
+
+def find_nebs(root='.'):
+    """All NEB folders below root, does not descend into NEB folders."""
+    nebs = []
+    for path, dirs, files in os.walk(root):
+        if is_neb(path):
+            nebs.append(path)
+            dirs[:] = []
+        elif '00' in dirs:
+            print('ATTENTION: {:} looks like a NEB but has no neb.dat/spline.dat, run nebresults.pl'.format(path))
+        dirs.sort()
+    return nebs
+
+
+def _outcars(path):
+    return sorted(glob.glob(os.path.join(path, '[0-9][0-9]', 'OUTCAR')))
+
+
+def signature(path, unit, plot, movie):
+    """Size and modification time of all inputs and the options, changes if the NEB has to be surveyed again."""
+    files = [os.path.join(path, 'neb.dat'), os.path.join(path, 'spline.dat')] + _outcars(path)
+    stats = [[os.path.relpath(f, path), os.path.getsize(f), os.stat(f).st_mtime_ns] for f in files]
+    return {'files': stats, 'unit': unit, 'plot': plot, 'movie': movie}
+
+
+def survey(path, unit='kJ/mol', plot=False, movie=False, cache=True):
+    """Barriers etc. of the NEB in path as a dict with the keys of COLUMNS, energies in unit.
+    dispersion: change of the dispersion energy from the first to the highest image,
+                np.nan if the OUTCARs are missing
+    plot, movie: also run plotNEB.py and neb2movie.py in path
+    Problems reading the NEB end up in error, the values are None then.
+    """
+    try:
+        return _survey(path, unit, plot, movie, cache)
+    except Exception as e:
+        return dict(dict.fromkeys(COLUMNS), path=path, unit=unit, error='ERROR: {}'.format(e))
+
+
+def _survey(path, unit, plot, movie, cache):
+    cacheFile = os.path.join(path, CACHE)
+    sig = signature(path, unit, plot, movie)
+    if cache and os.path.isfile(cacheFile):
+        try:
+            with open(cacheFile) as f:
+                cached = json.load(f)
+        except ValueError:
+            cached = {}
+        if cached.get('signature') == sig:
+            #the cache may have been written when the NEB was reached by another path
+            return dict(cached['result'], path=path)
+
+    data = plotNEB.neb_data(path, unit=unit)
+    energies = data['energies']
+    highest = int(np.argmax(energies))
+    dispersion = np.nan
+    outcars = [os.path.join(path, '{:02d}'.format(i), 'OUTCAR') for i in range(len(energies))]
+    if all(os.path.isfile(outcar) for outcar in outcars):
+        edisp = scan_outcars(outcars, ['edisp'], workers=1)['edisp']
+        dispersion = (edisp[highest] - edisp[0]) / plotNEB.unit_factor(unit)
+    result = {
+        'path': path,
+        'images': len(energies),
+        'forward_barrier': float(energies[highest] - energies[0]),
+        'reverse_barrier': float(energies[highest] - energies[-1]),
+        'highest_image': highest,
+        'max_force': float(np.abs(data['forces']).max()),
+        'dispersion': float(dispersion),
+        'unit': unit,
+        'error': '',
+    }
+
+    if plot:
+        plotNEB.main(unit=unit, plot_dispersion=not np.isnan(dispersion), workdir=path)
+    if movie:
+        neb2movie.main(os.path.join(path, 'movie.xyz'), path)
+    if cache:
+        #write and rename, an interrupted run must not leave a truncated cache
+        tmp = '{}.{}'.format(cacheFile, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'signature': sig, 'result': result}, f)
+        os.replace(tmp, cacheFile)
+    return result
+
+
+def write_table(filename, rows):
+    """Write rows (dicts with the keys of COLUMNS) as CSV or as Parquet if filename ends with .parquet (needs pandas)."""
+    if filename.endswith('.parquet'):
+        import pandas as pd
+        pd.DataFrame(rows, columns=COLUMNS).to_parquet(filename, index=False)
+        return
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(root='.', outFile='neb_survey.csv', unit='kJ/mol', plot=False, movie=False, cache=True, workers=1, verbose=True):
+    """
+        root: directory tree to search for NEB folders
+        outFile: table with one row per NEB, *.parquet or CSV
+        plot, movie: also create NEB.png and movie.xyz in every NEB folder
+        cache: reuse the results of unchanged NEBs
+        workers: number of NEBs processed in parallel
+    """
+    nebs = find_nebs(root)
+    if verbose: print("Found {:} NEBs below {:}".format(len(nebs), root))
+    results, failed = run_batch(survey, [(path, unit, plot, movie, cache) for path in nebs], workers=workers, verbose=verbose)
+    rows = [r for r in results if r is not None]
+    write_table(outFile, rows)
+    if verbose:
+        print("Wrote {:} NEBs to {:}, errors: {:}".format(len(rows), outFile, sum(bool(r.get('error')) for r in rows)))
+    return rows
+
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Collect barriers of all VTST NEBs in a directory tree')
+    parser.add_argument('root', type=str, help='Directory to search, default: .', nargs='?', default='.')
+    parser.add_argument('-o', type=str, help='Output table, *.parquet or CSV', default='neb_survey.csv')
+    parser.add_argument('--unit', help='Energy unit, must be ase compatible.', default='kJ/mol')
+    parser.add_argument('--plot', help='Run plotNEB.py in every NEB', action='store_true')
+    parser.add_argument('--movie', help='Run neb2movie.py in every NEB', action='store_true')
+    parser.add_argument('--nocache', help='Survey all NEBs again', action='store_true')
+    parser.add_argument('--jobs', help='Number of NEBs to process in parallel', type=int, default=1)
+    args = parser.parse_args()
+    main(args.root, args.o, args.unit, args.plot, args.movie, not args.nocache, args.jobs)
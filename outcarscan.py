@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+#
+# Script to get the last energies, forces etc. from (many) OUTCARs
+# by reading them backwards instead of parsing or grepping them completely.
+#
+# You can import the module and call .scan_outcar(), .scan_outcars() or .last_geometry() or use it as a script
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import os
+
+
+def _last_token(line):
+    return float(line.split()[-1])
+
+
+def _toten(line):
+    #free  energy   TOTEN  =      -123.45678901 eV
+    return float(line.split('=')[1].split()[0])
+
+
+def _vtst_force(line):
+    #FORCES: max atom, RMS     0.012345    0.004567
+    return float(line.split()[4])
+
+
+def _magnetization(line):
+    #number of electron     242.0000000 magnetization       2.0000000
+    return float(line.split('magnetization')[1].split()[0])
+
+
+#name: (marker, parser of the marker line)
+MARKERS = {
+    'edisp': (b'Edisp (eV)', _last_token),
+    'energy': (b'free  energy   TOTEN', _toten),
+    'force': (b'FORCES: max atom, RMS', _vtst_force),
+    'magnetization': (b'number of electron  ', _magnetization),
+    'max_force': (b'TOTAL-FORCE (eV/Angst)', None),
+}
+
+
+def find_last(f, markers, blocksize=2**20, stop=None):
+    """Offsets of the last occurrence of the markers (bytes) in the binary file f, reading it backwards in blocks.
+    stop: one of the markers, do not read further back once it was found
+    Returns a dict marker: offset, markers that were not found are missing.
+    """
+    overlap_size = max(len(marker) for marker in markers) - 1
+    found = {}
+    end = f.seek(0, os.SEEK_END)
+    overlap = b''
+    while end > 0 and len(found) < len(markers) and stop not in found:
+        start = max(0, end - blocksize)
+        f.seek(start)
+        #the beginning of the following block catches markers on the boundary
+        block = f.read(end - start) + overlap
+        for marker in markers:
+            if marker not in found:
+                i = block.rfind(marker)
+                if i >= 0:
+                    found[marker] = start + i
+        overlap = block[:overlap_size]
+        end = start
+    return found
+
+
+def _block(f):
+    """Rows of the POSITION/TOTAL-FORCE block starting at the current line."""
+    f.readline()
+    f.readline()
+    rows = []
+    for line in f:
+        if line.startswith(b' --'):
+            break
+        rows.append(line.split())
+    return np.array(rows, dtype=float).reshape(-1, 6)
+
+
+def _max_force(f):
+    """Largest atomic force of the POSITION/TOTAL-FORCE block starting at the current line."""
+    forces = _block(f)[:, 3:]
+    if len(forces) == 0:
+        return np.nan
+    return np.linalg.norm(forces, axis=1).max()
+
+
+def scan_outcar(filename, names=None, blocksize=2**20):
+    """Values at the last occurrence of the markers names (keys of MARKERS, default all) in one OUTCAR.
+    The file is read backwards in blocks of blocksize bytes until all markers are found.
+    Returns a dict name: value, np.nan if a marker was not found.
+    """
+    names = list(MARKERS) if names is None else list(names)
+    with open(filename, 'rb') as f:
+        found = find_last(f, [MARKERS[name][0] for name in names], blocksize)
+        values = {}
+        for name in names:
+            marker, parser = MARKERS[name]
+            if marker not in found:
+                values[name] = np.nan
+                continue
+            f.seek(found[marker])
+            if parser is None:
+                values[name] = _max_force(f)
+            else:
+                values[name] = parser(f.readline().decode())
+    return values
+
+
+def last_geometry(filename, atoms, blocksize=2**20):
+    """Copy of atoms (e.g. from the POSCAR of the calculation) with the cell and
+    positions of the last ionic step in the OUTCAR filename, read from the end of the file.
+    """
+    position = MARKERS['max_force'][0]
+    lattice = b'direct lattice vectors'
+    with open(filename, 'rb') as f:
+        found = find_last(f, [position, lattice], blocksize)
+        if position not in found:
+            raise ValueError("No positions found in {}".format(filename))
+        f.seek(found[position])
+        positions = _block(f)[:, :3]
+        if len(positions) != len(atoms):
+            raise ValueError("{} contains {} atoms, expected {}".format(filename, len(positions), len(atoms)))
+        atoms = atoms.copy()
+        if lattice in found:
+            f.seek(found[lattice])
+            f.readline()
+            atoms.set_cell([f.readline().split()[:3] for _ in range(3)])
+        atoms.set_positions(positions)
+    return atoms
+
+
+def scan_outcars(filenames, names=None, workers=8):
+    """scan_outcar for many files in a thread pool.
+    Returns a dict name: np.array with the values in the order of filenames.
+    """
+    names = list(MARKERS) if names is None else list(names)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda filename: scan_outcar(filename, names), filenames))
+    return {name: np.array([r[name] for r in results]) for name in names}
+
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Print the last energy, forces, dispersion energy and magnetization of OUTCARs.')
+    parser.add_argument('input', type=str, nargs='*', help='OUTCAR files (default: OUTCAR or NN/OUTCAR of a NEB)', default=None)
+    parser.add_argument('--markers', type=str, nargs='+', help='Values to print', choices=list(MARKERS), default=list(MARKERS))
+    parser.add_argument('--jobs', help='Number of files to read in parallel', type=int, default=8)
+    args = parser.parse_args()
+    files = args.input
+    if not files:
+        files = sorted(f for f in (os.path.join('{:02d}'.format(i), 'OUTCAR') for i in range(100)) if os.path.isfile(f))
+        if not files:
+            files = ['OUTCAR']
+    values = scan_outcars(files, args.markers, workers=args.jobs)
+    print(" ".join(['{:>16}'.format('file')] + ['{:>16}'.format(name) for name in args.markers]))
+    for i, filename in enumerate(files):
+        print(" ".join(['{:>16}'.format(filename)] + ['{:16.8f}'.format(values[name][i]) for name in args.markers]))
@@ -5,64 +5,19 @@
 # 2022/01
 #
 # You can import the module and then call .main() or use it as a script
-# Needs grep and tail.
-import argparse, os, subprocess, sys
+from concurrent.futures import ProcessPoolExecutor
+import argparse, os, sys
+import matplotlib, matplotlib.image
 import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from matplotlib.ticker import MaxNLocator
 from ase.units import create_units
+from outcarscan import scan_outcars
 
 
-def plot(reactionCoord, reactionCoordImageAxis, energies, energySpline, forces, filename, lw=3, s=0, highlight=None, dispersion=None, unit='kJ/mol'):
-    msbig = 9
-    ax = plt.figure().gca()
-    ax.xaxis.set_major_locator(MaxNLocator(integer=True))
-    plt.xlabel('Reaction Coordinate')# [Å]
-    ax.set_xticklabels([]) #no numbers on x
-    plt.ylabel(r'$\Delta E$ [{}]'.format(unit))
-    #plt.ylim([-10**exp,10**exp])
-    #plt.yscale('symlog')
-    #plt.gca().yaxis.grid(True)
-    plt.plot(reactionCoord, energySpline, color='black', ls=':', label='Cubic Spline', lw=lw)
-    plt.scatter(reactionCoordImageAxis, energies, marker='P', color='red', s=(msbig+s)**2, label='NEB Energy')
-    dScale = 0.02
-    maxX = max(reactionCoordImageAxis)
-    delta = dScale*maxX
-    yRange = max(energySpline) - min(energySpline)
-    for i,x in enumerate(reactionCoordImageAxis):
-        tangentX = [x-delta, x+delta]
-        tangentY = [energies[i]+(delta*forces[i]),energies[i]-(delta*forces[i])] #invert sign of forces from neb output
-        if i == 0:
-            label = 'NEB Force'
-        else:
-            label = None
-        # limit y range of tangent
-        tangentYRange = max(tangentY) - min(tangentY)
-        factor = delta * 0.1
-        n = 1
-        while tangentYRange > 0.1 * yRange:
-            delta -= factor
-            tangentX = [x-delta, x+delta]
-            tangentY = [energies[i]+(delta*forces[i]),energies[i]-(delta*forces[i])] #invert sign of forces from neb output
-            tangentYRange = max(tangentY) - min(tangentY)
-            n += 1
-            if n >= 11:
-                raise ValueError("Tangent Problem")
-        plt.plot(tangentX, tangentY, color='green', ls='-', lw=lw, label=label)
-
-    if highlight is not None:
-        plt.scatter(reactionCoordImageAxis[highlight], energies[highlight], marker='o', s=(msbig+s+30)**2, facecolors='none', edgecolors='orange', lw=lw+2, clip_on=False)
-
-    if dispersion is not None:
-        plt.scatter(reactionCoordImageAxis[1:], dispersion[1:], color='brown', marker='o', label='Dispersion', s=(msbig+s)**2)
-    #plt.xticks(x, printDirs[:], rotation=90)
-    plt.legend()
-    plt.tight_layout()
-    plt.savefig(filename)
-    #plt.show()
-    plt.close()
-
-
-def main(filename='NEB.png', presentation=False, highlight=None, plot_all=False, plot_dispersion=False, unit='kJ/mol'):
+def unit_factor(unit='kJ/mol'):
+    """Energies in eV divided by this factor are in unit (ase compatible, e.g. kJ/mol)."""
     unitDict = create_units('2014')
     conv = unitDict['eV'] #VASP and TST use eV
     if '/' in unit:
@@ -72,58 +27,171 @@ def main(filename='NEB.png', presentation=False, highlight=None, plot_all=False,
             conv /= unitDict[u]
     else:
         conv *= unitDict[unit]
+    return conv
+
+
+def tangents(reactionCoordImageAxis, energies, forces, yRange, dScale=0.02):
+    """End points of the force tangents, arrays of shape (nImages, 2) for x and y.
+    The half width is dScale of the largest reaction coordinate, shrunk per image so
+    that no tangent spans more than 10% of yRange.
+    """
+    x = np.asarray(reactionCoordImageAxis, dtype=float)
+    energies = np.asarray(energies, dtype=float)
+    forces = np.abs(np.asarray(forces, dtype=float))
+    delta = np.full(x.shape, dScale * x.max())
+    #y span of a tangent is 2*delta*|force|
+    steep = 2 * delta * forces > 0.1 * yRange
+    delta[steep] = 0.05 * yRange / forces[steep]
+    tangentX = np.stack([x - delta, x + delta], axis=1)
+    #invert sign of forces from neb output
+    tangentY = np.stack([energies + delta * forces, energies - delta * forces], axis=1)
+    return tangentX, tangentY
+
+
+def neb_data(path='.', unit='kJ/mol'):
+    """Read spline.dat and neb.dat of a VTST NEB (nebresults.pl) in path.
+    Returns a dict of arrays: reactionCoord, energySpline (spline), reactionCoordImageAxis, energies, forces,
+    tangentX, tangentY (images), energies in unit.
+    """
+    conv = unit_factor(unit)
+    spline = np.loadtxt(os.path.join(path, 'spline.dat'), ndmin=2)
+    nebData = np.loadtxt(os.path.join(path, 'neb.dat'), ndmin=2)
+    data = {
+        'reactionCoord': spline[:, 1],
+        'energySpline': spline[:, 2] / conv,
+        'reactionCoordImageAxis': nebData[:, 1],
+        'energies': nebData[:, 2] / conv,
+        'forces': nebData[:, 3] / conv,
+    }
+    data['tangentX'], data['tangentY'] = tangents(data['reactionCoordImageAxis'], data['energies'], data['forces'], np.ptp(data['energySpline']))
+    return data
+
+
+def draw(reactionCoord, reactionCoordImageAxis, energies, energySpline, forces, lw=3, s=0, dispersion=None, unit='kJ/mol'):
+    """Figure with everything but the highlight, rendered by Agg without pyplot."""
+    msbig = 9
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.gca()
+    ax.xaxis.set_major_locator(MaxNLocator(integer=True))
+    ax.set_xlabel('Reaction Coordinate')# [Å]
+    ax.set_xticklabels([]) #no numbers on x
+    ax.set_ylabel(r'$\Delta E$ [{}]'.format(unit))
+    #ax.set_ylim([-10**exp,10**exp])
+    #ax.set_yscale('symlog')
+    #ax.yaxis.grid(True)
+    ax.plot(reactionCoord, energySpline, color='black', ls=':', label='Cubic Spline', lw=lw)
+    ax.scatter(reactionCoordImageAxis, energies, marker='P', color='red', s=(msbig+s)**2, label='NEB Energy')
+    tangentX, tangentY = tangents(reactionCoordImageAxis, energies, forces, np.ptp(energySpline))
+    lines = ax.plot(tangentX.T, tangentY.T, color='green', ls='-', lw=lw)
+    lines[0].set_label('NEB Force')
+
+    if dispersion is not None:
+        ax.scatter(reactionCoordImageAxis[1:], dispersion[1:], color='brown', marker='o', label='Dispersion', s=(msbig+s)**2)
+    #ax.set_xticks(x, printDirs[:], rotation=90)
+    ax.legend()
+    fig.tight_layout()
+    return fig
+
+
+def add_highlight(fig, x, y, lw=3, s=0):
+    """Circle around point (x, y), move it later with .set_offsets()."""
+    msbig = 9
+    return fig.gca().scatter([x], [y], marker='o', s=(msbig+s+30)**2, facecolors='none', edgecolors='orange', lw=lw+2, clip_on=False)
+
+
+def plot(reactionCoord, reactionCoordImageAxis, energies, energySpline, forces, filename, lw=3, s=0, highlight=None, dispersion=None, unit='kJ/mol', rc=None):
+    with matplotlib.rc_context(rc):
+        fig = draw(reactionCoord, reactionCoordImageAxis, energies, energySpline, forces, lw=lw, s=s, dispersion=dispersion, unit=unit)
+        if highlight is not None:
+            add_highlight(fig, reactionCoordImageAxis[highlight], energies[highlight], lw=lw, s=s)
+        fig.savefig(filename)
+
+
+def plot_frames(reactionCoord, reactionCoordImageAxis, energies, energySpline, forces, filenames, highlights, lw=3, s=0, dispersion=None, unit='kJ/mol', rc=None):
+    """One plot per entry of highlights, the figure is only drawn once and the highlight moved.
+    PNGs are blitted: the rendered background is restored and only the highlight drawn on top.
+    """
+    with matplotlib.rc_context(rc):
+        fig = draw(reactionCoord, reactionCoordImageAxis, energies, energySpline, forces, lw=lw, s=s, dispersion=dispersion, unit=unit)
+        circle = add_highlight(fig, reactionCoordImageAxis[highlights[0]], energies[highlights[0]], lw=lw, s=s)
+        blit = all(f.lower().endswith('.png') for f in filenames)
+        if blit:
+            if matplotlib.rcParams['savefig.dpi'] != 'figure':
+                fig.set_dpi(matplotlib.rcParams['savefig.dpi'])
+            circle.set_animated(True)
+            fig.canvas.draw()
+            background = fig.canvas.copy_from_bbox(fig.bbox)
+        for filename, i in zip(filenames, highlights):
+            circle.set_offsets([[reactionCoordImageAxis[i], energies[i]]])
+            if blit:
+                fig.canvas.restore_region(background)
+                fig.draw_artist(circle)
+                matplotlib.image.imsave(filename, np.asarray(fig.canvas.buffer_rgba()), dpi=fig.dpi)
+            else:
+                fig.savefig(filename)
+
+
+def main(filename='NEB.png', presentation=False, highlight=None, plot_all=False, plot_dispersion=False, unit='kJ/mol', workers=1, workdir='.'):
+    """
+        workdir: folder of the NEB, filename is relative to it
+    """
+    conv = unit_factor(unit)
     print("Unit conversion factor from eV to {}: {:}".format(unit, conv))
 
-    spline = np.loadtxt('spline.dat')
-    print("Spline loaded.")
-    nebData = np.loadtxt('neb.dat')
-    print("Energy and forces loaded.")
-    nImages = len(nebData)
+    data = neb_data(workdir, unit=unit)
+    filename = os.path.join(workdir, filename)
+    print("Spline, energies and forces loaded.")
+    reactionCoord = data['reactionCoord']
+    energySpline = data['energySpline']
+    reactionCoordImageAxis = data['reactionCoordImageAxis']
+    energies = data['energies']
+    forces = data['forces']
+    nImages = len(energies)
     print("{:} data points found.".format(nImages))
 
-    reactionCoord = [ s[1] for s in spline ]
-    xAxis = [ s[0] for s in spline ]
-    #images = [ d[0] for d in nebData ]
-    reactionCoordImageAxis = [ d[1] for d in nebData ]
-    #reactionCoordImageAxis = [ reactionCoord[xAxis.index(n)] for n in images ]
-    energies = [ d[2]/conv for d in nebData ]
-    forces = [ d[3]/conv for d in nebData ]
-    energySpline = [ s[2]/conv for s in spline ]
-
     if presentation:
         lw = 5
         s = 3
-        plt.rcParams.update({'font.size': 22})
-        plt.rcParams.update({'legend.fontsize': 22})
+        rc = {'font.size': 22, 'legend.fontsize': 22}
     else:
         lw = 3
         s = 0
+        rc = None
 
     dispersion = None
     if plot_dispersion:
         print("Collecting dispersion energies from OUTCARs.")
-        dispersion = []
+        outcars = []
         for i in range(nImages):
-            path = "{:02d}".format(i)
+            path = os.path.join(workdir, "{:02d}".format(i))
             assert os.path.isdir(path), "Could not find dir {}".format(path)
             outcar = os.path.join(path,'OUTCAR')
             assert os.path.isfile(outcar), "Could not find file {}".format(outcar)
-            child = subprocess.Popen(["grep 'Edisp (eV)' {:} | tail -1".format(outcar)], stdout=subprocess.PIPE, shell=True)
-            dispE = float(child.communicate()[0].strip().split()[-1])
-            dispersion.append(dispE)
-        dispersion = np.array(dispersion)
+            outcars.append(outcar)
+        dispersion = scan_outcars(outcars, ['edisp'])['edisp']
+        if np.isnan(dispersion).any():
+            raise ValueError("No dispersion energy found in {}".format(outcars[np.isnan(dispersion).argmax()]))
         dispersion -= dispersion[0]
         dispersion /= conv
 
-    plot(reactionCoord, reactionCoordImageAxis, energies, energySpline, forces, filename, lw=lw, s=s, highlight=highlight, dispersion=dispersion, unit=unit)
+    plot(reactionCoord, reactionCoordImageAxis, energies, energySpline, forces, filename, lw=lw, s=s, highlight=highlight, dispersion=dispersion, unit=unit, rc=rc)
 
     if plot_all:
         #plot the main image and then one with every point highlighted
-        filename = filename.split('.')
-        filename[-2] += "-{:02d}"
-        filename = ".".join(filename)
-        for i in range(nImages):
-            plot(reactionCoord, reactionCoordImageAxis, energies, energySpline, forces, filename.format(i), lw=lw, s=s, highlight=i, dispersion=dispersion, unit=unit)
+        root, extension = os.path.splitext(filename)
+        filename = root + "-{:02d}" + extension
+        #every worker draws the figure once and only moves the highlight
+        chunks = np.array_split(np.arange(nImages), max(1, min(workers, nImages)))
+        args = (reactionCoord, reactionCoordImageAxis, energies, energySpline, forces)
+        kwargs = {'lw': lw, 's': s, 'dispersion': dispersion, 'unit': unit, 'rc': rc}
+        if len(chunks) == 1:
+            plot_frames(*args, [filename.format(i) for i in chunks[0]], chunks[0].tolist(), **kwargs)
+        else:
+            with ProcessPoolExecutor(max_workers=len(chunks)) as pool:
+                jobs = [pool.submit(plot_frames, *args, [filename.format(i) for i in c], c.tolist(), **kwargs) for c in chunks]
+                for job in jobs:
+                    job.result()
 
 
 if __name__ == "__main__":
@@ -135,5 +203,6 @@ if __name__ == "__main__":
     parser.add_argument('--plotall', help='Create main plot and each highlighted plot.', action='store_true')
     parser.add_argument('--plotdispersion', help='Include dispersion contributions in plot.', action='store_true')
     parser.add_argument('--unit', help='Set the unit used to plot, must be ase compatible.', default='kJ/mol')
+    parser.add_argument('--jobs', help='Number of processes for --plotall', type=int, default=1)
     args = parser.parse_args()
-    main(args.file, args.presentation, args.highlight, args.plotall, args.plotdispersion, args.unit)
+    main(args.file, args.presentation, args.highlight, args.plotall, args.plotdispersion, args.unit, args.jobs)
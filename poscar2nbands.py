@@ -4,18 +4,211 @@
 # by Patrick Melix
 # 2022/03/10
 #
+# NBANDS is the number of LOBSTER basis functions (pymatgen's standard basis for the
+# POTCARs) of all atoms in the POSCAR. The dataset headers of every distinct POTCAR are only
+# parsed once and, like the basis functions of every POTCAR symbol, cached in VASPTOOLS_CACHE
+# (see gridcache.py), shared by parallel workers and later runs.
+#
+from batch import run_batch
+from functools import lru_cache
+import hashlib, json, mmap, os
+
+#number of functions per orbital type
+ORBITALS = {'s': 1, 'p': 3, 'd': 5, 'f': 7}
+
+
+HEADER_CACHE = 'potcar_headers.json'
+BASIS_CACHE = 'lobster_basis.json'
+BASIS_FILE = 'BASIS_PBE_54_standard.yaml'
+
+
+def _cache_file(name):
+    from gridcache import cache_dir
+    return os.path.join(cache_dir(), name)
+
+
+def _read_json(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(filename, data):
+    """Write and rename, parallel workers never see a partially written cache."""
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp = '{}.{}'.format(filename, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, filename)
+
+
+def _scan_potcar(m, size):
+    """Kind, symbol and valence electrons of all datasets in the memory-mapped POTCAR m."""
+    #every dataset ends with 'End of Dataset', the next one starts after it
+    starts = [0]
+    end = m.find(b'End of Dataset')
+    while end >= 0:
+        start = m.find(b'\n', end) + 1
+        while 0 < start < size and m[start:start+1].isspace():
+            start += 1
+        if start <= 0 or start >= size:
+            break
+        starts.append(start)
+        end = m.find(b'End of Dataset', start)
+    headers = []
+    for start in starts:
+        #  PAW_PBE Fe_pv 06Sep2000
+        #  14.0000000000000000
+        end = m.find(b'\n', start)
+        title = m[start:end].split()
+        zval = float(m[end+1:m.find(b'\n', end+1)])
+        headers.append([title[0].decode(), title[1].decode(), zval])
+    return headers
+
+
+def _potcar_headers(path):
+    """Datasets of the POTCAR at path (see _scan_potcar), cached on disk: the datasets by the
+    SHA-1 of the content, so identical POTCARs of other folders are only parsed once, and the
+    content of every path by device, inode, size and modification time, so known files are not read at all.
+    """
+    stat = os.stat(path)
+    fileKey = [stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+    cacheFile = _cache_file(HEADER_CACHE)
+    cache = _read_json(cacheFile)
+    headers = cache.get('headers', {})
+    known = cache.get('files', {}).get(path)
+    if known and known[:4] == fileKey and known[4] in headers:
+        return headers[known[4]]
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        key = hashlib.sha1(m).hexdigest()
+        datasets = headers.get(key) or _scan_potcar(m, stat.st_size)
+    #merge with the entries other processes stored in the meantime
+    cache = _read_json(cacheFile)
+    cache.setdefault('files', {})[path] = fileKey + [key]
+    cache.setdefault('headers', {})[key] = datasets
+    _write_json(cacheFile, cache)
+    return datasets
+
+
+def read_potcar(filename='POTCAR'):
+    """POTCAR symbols and valence electrons of all datasets in filename, only reading their headers."""
+    headers = _potcar_headers(os.path.realpath(filename))
+    for kind, symbol, _ in headers:
+        if not kind.startswith('PAW'):
+            raise ValueError("Lobster only works with PAW! Use different POTCARs")
+        if not kind.startswith('PAW_PBE'):
+            raise RuntimeError("We only have BASIS options for PBE so far")
+    return [h[1] for h in headers], [h[2] for h in headers]
+
+
+def read_poscar(filename='POSCAR'):
+    """Species and atom counts of the POSCAR, species is None for POSCARs without element line."""
+    with open(filename) as f:
+        lines = [f.readline() for _ in range(7)]
+    if lines[5].split()[0].isdigit():
+        return None, [int(n) for n in lines[5].split()]
+    return lines[5].split(), [int(n) for n in lines[6].split()]
+
+
+@lru_cache(maxsize=None)
+def _basis_source():
+    """Origin of the basis functions, cached values of another source are not used."""
+    from importlib.metadata import PackageNotFoundError, version
+    try:
+        return 'pymatgen {} {}'.format(version('pymatgen'), BASIS_FILE)
+    except PackageNotFoundError:
+        return 'unknown {}'.format(BASIS_FILE)
+
+
+@lru_cache(maxsize=None)
+def _load_basis():
+    from monty.serialization import loadfn
+    from pymatgen.io.lobster.inputs import MODULE_DIR
+    return loadfn(os.path.join(MODULE_DIR, 'lobster_basis', BASIS_FILE))['BASIS']
+
+
+def basis_functions(symbols):
+    """Number of LOBSTER standard basis functions of the POTCAR symbols (e.g. Fe_pv), cached on disk
+    per basis source (pymatgen version and basis file) so the basis file is only read for new symbols."""
+    cacheFile = _cache_file(BASIS_CACHE)
+    source = _basis_source()
+    functions = _read_json(cacheFile).get(source, {})
+    missing = [s for s in symbols if s not in functions]
+    if missing:
+        basis = _load_basis()
+        for symbol in missing:
+            if symbol not in basis:
+                raise ValueError("Missing basis information for POTCAR symbol: {}. Please provide the basis manually.".format(symbol))
+            functions[symbol] = sum(ORBITALS[orbital[-1]] for orbital in basis[symbol].split())
+        #one dict of functions per source, drops the entries of older cache layouts
+        cache = {key: value for key, value in _read_json(cacheFile).items() if isinstance(value, dict)}
+        cache.setdefault(source, {}).update(functions)
+        _write_json(cacheFile, cache)
+    return [functions[s] for s in symbols]
+
+
+def nbands(path='.'):
+    """NBANDS for LOBSTER and number of valence electrons of the POSCAR and POTCAR in path."""
+    symbols, zvals = read_potcar(os.path.join(path, 'POTCAR'))
+    species, counts = read_poscar(os.path.join(path, 'POSCAR'))
+    elements = [s.split('_')[0] for s in symbols]
+    if species is None:
+        species = elements
+    if set(species) != set(elements) or len(counts) != len(symbols):
+        raise ValueError("Your POSCAR does not correspond to your POTCAR!")
+    #basis of an element from its (first) POTCAR
+    functions = dict(reversed(list(zip(elements, basis_functions(symbols)))))
+    return {'path': path,
+            'formula': ''.join('{}{}'.format(s, n) for s, n in zip(species, counts)),
+            'nelect': sum(n * z for n, z in zip(counts, zvals)),
+            'nbands': sum(n * functions[s] for s, n in zip(species, counts))}
 
 
 def get_nbands():
-    from pymatgen.core.structure import Structure
-    from pymatgen.io.lobster import Lobsterin
-    lobsterin = Lobsterin.standard_calculations_from_vasp_files("POSCAR", "INCAR", "POTCAR", option='standard')
-    print(lobsterin._get_nbands(Structure.from_file("POSCAR")))
+    print(nbands('.')['nbands'])
+
+
+def main(paths, outFile=None, workers=1):
+    """
+        paths: folders with POSCAR and POTCAR
+        outFile: CSV table of path, formula, nelect and nbands, None to print it
+        workers: number of folders processed in parallel
+    """
+    import csv, sys
+    results, failed = run_batch(nbands, [(path,) for path in paths], workers=workers)
+    rows = [r for r in results if r is not None]
+    f = open(outFile, 'w', newline='') if outFile else sys.stdout
+    writer = csv.DictWriter(f, fieldnames=['path', 'formula', 'nelect', 'nbands'])
+    writer.writeheader()
+    writer.writerows(rows)
+    if outFile:
+        f.close()
+    return rows
 
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(
-        description='Get NBANDS for LOBSTER from current POSCAR, POTCAR and INCAR')
+        description='Get NBANDS for LOBSTER from current POSCAR and POTCAR')
+    parser.add_argument(
+        'paths',
+        type=str,
+        nargs='*',
+        help='folders to write a table for, default: print NBANDS of the current folder')
+    parser.add_argument(
+        '-o',
+        type=str,
+        help='CSV file for the table of the folders, default: print it',
+        default=None)
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        help='number of folders processed in parallel',
+        default=1)
     args = parser.parse_args()
-    get_nbands()
+    if args.paths:
+        main(args.paths, args.o, args.jobs)
+    else:
+        get_nbands()
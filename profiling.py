@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+#
+# Wall time, bytes read/written and peak memory of the stages (parse, convert, write, ...)
+# of the tools, one JSON record per input file.
+#
+# Enabled with --profile FILE of the scripts or VASPTOOLS_PROFILE=FILE, every input appends
+# one line of JSON to FILE (- for stderr). --cprofile DIR or VASPTOOLS_CPROFILE=DIR also dumps
+# the cProfile statistics of every input into DIR (view them with python -m pstats).
+# Bytes are counted by the kernel (rchar/wchar of /proc/self/io) and include everything this
+# process read or wrote during the stage (not the pages of memory-mapped files), they are
+# null where /proc is not available. Memory is the increase of the peak resident memory of
+# the process during a stage (peak_rss_increase_mb), a stage staying below the peak of
+# earlier stages gets 0. process_peak_rss_mb of the record is the peak of the whole process.
+# Run this script on a profile file to get the totals per tool and stage.
+#
+# In the tools:
+#   with profile('chgcar2cube', inFile):
+#       with stage('parse'):
+#           ...
+# stage and iterate can be used anywhere, they do nothing unless a profile is active.
+from contextlib import contextmanager, nullcontext
+import json, os, resource, socket, sys, time
+
+PROFILE = 'VASPTOOLS_PROFILE'
+CPROFILE = 'VASPTOOLS_CPROFILE'
+
+#active profiles of this process, the innermost last
+_active = []
+_dumps = 0
+
+
+def _io():
+    """Bytes read and written by this process so far, None if not available."""
+    try:
+        with open('/proc/self/io', 'rb') as f:
+            values = dict(line.split(b':') for line in f)
+        return int(values[b'rchar']), int(values[b'wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _diff(new, old):
+    return None if new is None or old is None else new - old
+
+
+class Profile:
+    """Stages of one input file, see profile. Nested stages are only counted for the inner one."""
+
+    def __init__(self, tool, inFile):
+        self.record = {'tool': tool, 'input': inFile, 'host': socket.gethostname(), 'pid': os.getpid(),
+                       'start': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seconds': None, 'process_peak_rss_mb': None,
+                       'stages': {}, 'error': None}
+        #time, bytes read and written and peak memory increase of the nested stages of every running stage
+        self._nested = []
+
+    @contextmanager
+    def stage(self, name):
+        read, written = _io()
+        peak = _peak_rss()
+        start = time.perf_counter()
+        self._nested.append([0.0, 0, 0, 0.0])
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            newRead, newWritten = _io()
+            inclusive = [seconds, _diff(newRead, read), _diff(newWritten, written), _peak_rss() - peak]
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] = [a + (b or 0) for a, b in zip(self._nested[-1], inclusive)]
+            entry = self.record['stages'].setdefault(name, {'calls': 0, 'seconds': 0.0, 'bytes_read': 0, 'bytes_written': 0, 'peak_rss_increase_mb': 0.0})
+            entry['calls'] += 1
+            entry['seconds'] += inclusive[0] - nested[0]
+            for key, value, inner in zip(['bytes_read', 'bytes_written'], inclusive[1:3], nested[1:3]):
+                entry[key] = None if value is None or entry[key] is None else entry[key] + value - inner
+            entry['peak_rss_increase_mb'] += inclusive[3] - nested[3]
+
+
+def write_record(filename, record):
+    """Append record as one line of JSON to filename, - for stderr."""
+    line = json.dumps(record) + '\n'
+    if filename == '-':
+        sys.stderr.write(line)
+        return
+    #a single write in append mode, records of parallel workers do not mix
+    with open(filename, 'a') as f:
+        f.write(line)
+
+
+@contextmanager
+def profile(tool, inFile):
+    """Profile the work on inFile by tool if enabled (see the top of this file), yields the Profile or None."""
+    global _dumps
+    filename = os.environ.get(PROFILE)
+    dumpDir = os.environ.get(CPROFILE)
+    if not (filename or dumpDir):
+        yield None
+        return
+    prof = Profile(tool, inFile)
+    profiler = None
+    if dumpDir and not _active:
+        #only one cProfile can run at a time, nested profiles are part of the outer dump
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    _active.append(prof)
+    start = time.perf_counter()
+    try:
+        yield prof
+    except BaseException as e:
+        prof.record['error'] = '{}: {}'.format(type(e).__name__, e)
+        raise
+    finally:
+        _active.remove(prof)
+        prof.record['seconds'] = time.perf_counter() - start
+        prof.record['process_peak_rss_mb'] = _peak_rss()
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(dumpDir, exist_ok=True)
+            _dumps += 1
+            name = os.path.basename(str(inFile).rstrip('/')) or 'input'
+            dump = os.path.join(dumpDir, '{}-{}-{}-{}.prof'.format(tool, name, os.getpid(), _dumps))
+            profiler.dump_stats(dump)
+            prof.record['cprofile'] = dump
+        if filename:
+            write_record(filename, prof.record)
+
+
+def stage(name):
+    """Count the enclosed code as stage name of the active profile."""
+    if not _active:
+        return nullcontext()
+    return _active[-1].stage(name)
+
+
+def iterate(name, iterable):
+    """Count the time spent producing the items of iterable as stage name of the active profile."""
+    if not _active:
+        return iterable
+    return _iterate(_active[-1], name, iterable)
+
+
+def _iterate(prof, name, iterable):
+    iterator = iter(iterable)
+    while True:
+        with prof.stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def add_profile_arguments(parser):
+    """Command line options to enable the profiling, see setup."""
+    parser.add_argument('--profile', type=str, help='Append time, I/O and memory of every stage per input as JSON line to this file (- for stderr)', default=None)
+    parser.add_argument('--cprofile', type=str, help='Dump cProfile statistics of every input into this folder', default=None)
+
+
+def setup(args):
+    """Enable the profiling from the parsed command line options.
+    Done through the environment, so pool workers of run_batch inherit it."""
+    if args.profile:
+        os.environ[PROFILE] = os.path.abspath(args.profile) if args.profile != '-' else '-'
+    if args.cprofile:
+        os.environ[CPROFILE] = os.path.abspath(args.cprofile)
+
+
+def summarize(filename):
+    """Totals of time and I/O, number of inputs and the largest peak memory increase of one input
+    per tool and stage of a profile file."""
+    totals = {}
+    with open(filename) as f:
+        for line in f:
+            record = json.loads(line)
+            for name, entry in record['stages'].items():
+                total = totals.setdefault((record['tool'], name), {'inputs': 0, 'seconds': 0.0, 'bytes_read': 0, 'bytes_written': 0, 'peak_rss_increase_mb': 0.0})
+                total['inputs'] += 1
+                total['seconds'] += entry['seconds']
+                total['bytes_read'] += entry['bytes_read'] or 0
+                total['bytes_written'] += entry['bytes_written'] or 0
+                total['peak_rss_increase_mb'] = max(total['peak_rss_increase_mb'], entry['peak_rss_increase_mb'])
+    return totals
+
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Print the totals per tool and stage of profile files written with --profile')
+    parser.add_argument('input', type=str, nargs='+', help='Profile files (JSON lines)')
+    args = parser.parse_args()
+    for filename in args.input:
+        print(filename)
+        print("{:20s} {:12s} {:>7s} {:>10s} {:>12s} {:>12s} {:>10s}".format('tool', 'stage', 'inputs', 'seconds', 'read MB', 'written MB', '+peak MB'))
+        for (tool, name), t in summarize(filename).items():
+            print("{:20s} {:12s} {:7d} {:10.3f} {:12.1f} {:12.1f} {:10.1f}".format(
+                  tool, name, t['inputs'], t['seconds'], t['bytes_read'] / 2**20, t['bytes_written'] / 2**20, t['peak_rss_increase_mb']))
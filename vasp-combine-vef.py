@@ -1,47 +1,44 @@
 #!/usr/bin/env python3
 from natsort import natsorted
-import glob, os, json
-import subprocess
+from profiling import add_profile_arguments, profile, setup, stage
+from vasprunscan import FeParser, read_many, write_fe
+from xml.etree.ElementTree import ParseError
+import argparse, glob, os, time
 import numpy as np
 exec(open("/home/patrickm/git/Python4ChemistryTools/mpl-settings.py").read())
 
-files = natsorted(glob.glob('./*/vasprun.xml', recursive=True))
-if os.path.isfile('./vasprun.xml'):
-    files.append('./vasprun.xml')
-data = []
+parser = argparse.ArgumentParser(description='Plot energy and maximum force along a chain of GO restarts (subfolders 1, 2, ... and this folder).')
+parser.add_argument('-o', type=str, help='Combined series, json or *.npz', default='fe-combined.json')
+parser.add_argument('--jobs', help='Number of vasprun.xml to read in parallel', type=int, default=1)
+parser.add_argument('--watch', help='Keep running and update fe.png whenever new ionic steps were written', action='store_true')
+parser.add_argument('--interval', help='Seconds between two updates with --watch', type=float, default=60)
+add_profile_arguments(parser)
+args = parser.parse_args()
+setup(args)
 
-for f in files:
-    folder = os.path.dirname(os.path.abspath(f))
-    if (not os.path.basename(folder).isdigit()) and (not os.path.realpath(folder) == os.path.realpath(os.getcwd())):
-        print("Not using {}".format(folder))
-        continue
-    if os.path.isfile(os.path.join(folder,'fe.dat')):
-        print("Adding {}".format(folder))
-    else:
-        print("Running vef.py in {}".format(folder))
-        p = subprocess.Popen(['vef.py'], cwd=folder)
-        p.wait()
-        assert os.path.isfile(os.path.join(folder,'fe.dat')), "Problem running vef.py in {:}".format(folder)
-    data.append(np.loadtxt(os.path.join(folder,'fe.dat')))
-    print("Found {} values".format(len(data[-1])))
-combined = {}
-combined['force'] = []
-combined['energy'] = []
-for d in data:
-    # filter one entry runs
-    if d.shape == (4,):
-        combined['force'].append(d[1])
-        combined['energy'].append(d[2])
-    else:
-        combined['force'].extend(d[:,1].tolist())
-        combined['energy'].extend(d[:,2].tolist())
-nItems = len(combined['force'])
-with open('fe-combined.json','w') as f:
-    json.dump(combined, f)
 
-xAxis = list(range(1, nItems+1))
+def find_files(verbose=True):
+    files = natsorted(glob.glob('./*/vasprun.xml', recursive=True))
+    if os.path.isfile('./vasprun.xml'):
+        files.append('./vasprun.xml')
+    use = []
+    for f in files:
+        folder = os.path.dirname(os.path.abspath(f))
+        if (not os.path.basename(folder).isdigit()) and (not os.path.realpath(folder) == os.path.realpath(os.getcwd())):
+            if verbose: print("Not using {}".format(folder))
+            continue
+        if verbose: print("Adding {}".format(folder))
+        use.append(f)
+    return use
 
-def plot(filename,lw=2):
+
+def combine(data):
+    data = np.concatenate(data) if data else np.empty((0, 2))
+    return {'energy': data[:,0], 'force': data[:,1]}
+
+
+def plot(filename, combined, lw=2):
+    xAxis = list(range(1, len(combined['energy'])+1))
     fig, ax1 = plt.subplots()
     plt.xlabel('Step #')# [Å]
     color = 'black'
@@ -62,11 +59,59 @@ def plot(filename,lw=2):
     #plt.show()
     plt.close()
 
-plot('fe.png', lw=2)
 
-#Presentation
-plt.rcParams.update({'font.size': 22})
-plt.rcParams.update({'legend.fontsize': 22})
-plot('fe_presentations.png', lw=4)
+if args.watch:
+    #one parser per file, every update only reads the bytes appended since the last one
+    parsers = {}
+    try:
+        while True:
+            new, reset = 0, False
+            files = find_files(verbose=False)
+            for f in files:
+                if f not in parsers:
+                    print("Adding {}".format(os.path.dirname(os.path.abspath(f))))
+                    parsers[f] = FeParser()
+                try:
+                    new += len(parsers[f].read_new(f))
+                except ParseError as e:
+                    #e.g. replaced while reading, start over with the next update
+                    print("ATTENTION: Could not parse {}, reading it again: {}".format(f, e))
+                    parsers[f] = FeParser()
+                    reset = True
+            if new or reset:
+                combined = combine([np.array(parsers[f].steps).reshape(-1, 2) for f in files])
+                write_fe(args.o, combined['energy'], combined['force'])
+                #a reset parser may leave no ionic steps at all
+                if len(combined['energy']) > 0:
+                    plot('fe.png', combined, lw=2)
+                    print("{}: {} new steps, {} in total, E = {:.6f} eV, max(F) = {:.4f} eV/Å".format(
+                          time.strftime('%H:%M:%S'), new, len(combined['energy']), combined['energy'][-1], combined['force'][-1]))
+                else:
+                    print("{}: no ionic steps yet".format(time.strftime('%H:%M:%S')))
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print('...Done!')
+        raise SystemExit
+
+#the vasprun.xml files get their own records from vasprunscan.read_fe
+with profile('vasp-combine-vef', os.getcwd()):
+    files = find_files()
+    with stage('parse'):
+        data = read_many(files, workers=args.jobs)
+    for f, d in zip(files, data):
+        assert d is not None, "Problem reading {:}".format(f)
+        print("Found {} values in {}".format(len(d), f))
+    with stage('convert'):
+        combined = combine(data)
+    with stage('write'):
+        write_fe(args.o, combined['energy'], combined['force'])
+
+    with stage('plot'):
+        plot('fe.png', combined, lw=2)
+
+        #Presentation
+        plt.rcParams.update({'font.size': 22})
+        plt.rcParams.update({'legend.fontsize': 22})
+        plot('fe_presentations.png', combined, lw=4)
 
 print('...Done!')
@@ -5,40 +5,409 @@
 # 2018/03/13
 #
 # You can import the module and then call .main() or use it as a script
-from ase import io
-import os
+from ase import Atoms
+from ase.io.extxyz import write_extxyz
+from ase.io.vasp import iread_vasp_out
+from ase.io.vasp_parsers.vasp_outcar_parsers import OUTCARChunk, OutcarHeaderParser, build_chunk, build_header
+from itertools import chain, islice
+from profiling import add_profile_arguments, iterate, profile, setup, stage
+import numpy as np
+import hashlib, json, mmap, os
 
-def main(outFile, inFiles, wrap):
-    #if output exists mv to .bak
-    if os.path.isfile(outFile):
-        print('ATTENTION: {:} exists, moving to *.bak'.format(outFile))
-        os.rename(outFile, outFile+'.bak')
+OUTCAR_DELIMITER = b'FREE ENERGIE OF THE ION-ELECTRON SYSTEM'
+XDATCAR_DELIMITER = b'configuration='
+INDEX_DIR = 'frame-index'
+
+
+def _read_xdatcar_header(fd):
+    """Read an XDATCAR header (comment up to the atom counts), returns cell, formula and number of atoms."""
+    fd.readline()
+    scale = float(fd.readline())
+    cell = np.array([[float(x) for x in fd.readline().split()] for _ in range(3)]) * scale
+    symbols = fd.readline().split()
+    numbers = [int(n) for n in fd.readline().split()]
+    formula = ''.join('{}{}'.format(s, n) for s, n in zip(symbols, numbers))
+    return cell, formula, sum(numbers)
+
+
+def _read_xdatcar_frame(fd, header):
+    """Read the positions following a 'Direct configuration=' line, None if incomplete."""
+    cell, formula, total = header
+    #readline instead of iterating, iterating disables fd.tell()
+    lines = [fd.readline() for _ in range(total)]
+    if not lines[-1].endswith('\n'):
+        #incomplete last frame of a running job
+        return None
+    image = Atoms(formula, cell=cell, pbc=True)
+    image.set_scaled_positions(np.array([line.split()[:3] for line in lines], dtype=float))
+    return image
+
+
+def iread_xdatcar(fd):
+    """Yield the frames of an XDATCAR one by one (ase.io.read keeps all of them in memory).
+    Works for fixed and variable cell XDATCARs.
+    """
+    header = None
+    while True:
+        position = fd.tell()
+        line = fd.readline()
+        if not line:
+            return
+        if "configuration=" not in line:
+            #new header, always the case for the first frame and variable cells
+            fd.seek(position)
+            try:
+                header = _read_xdatcar_header(fd)
+            except ValueError:
+                return
+            fd.readline()
+        image = _read_xdatcar_frame(fd, header)
+        if image is None:
+            return
+        yield image
+
+
+def _tail_hash(mm, end):
+    """Hash of the 4 kB before end, used to check that a file was only appended to."""
+    return hashlib.sha1(mm[max(0, end-4096):end]).hexdigest()
+
+
+def _scan_xdatcar(mm, position, index):
+    """Append the offsets of all complete XDATCAR frames after position to index."""
+    while True:
+        found = mm.find(XDATCAR_DELIMITER, position)
+        if found < 0:
+            break
+        start = mm.rfind(b'\n', 0, found) + 1
+        previous = mm.rfind(b'\n', 0, max(start - 1, 0)) + 1
+        if start == 0 or b'.' not in mm[previous:start]:
+            #preceded by the atom counts instead of coordinates: new header 7 lines above
+            header = start
+            for _ in range(7):
+                header = mm.rfind(b'\n', 0, max(header - 1, 0)) + 1
+            index['headers'].append(header)
+            index['natoms'] = sum(int(n) for n in mm[previous:start].split())
+        elif index['headers']:
+            index['headers'].append(index['headers'][-1])
+        end = start
+        for _ in range(index['natoms'] + 1):
+            end = mm.find(b'\n', end) + 1
+            if end == 0:
+                #incomplete frame
+                index['headers'].pop()
+                return
+        index['offsets'].append(start)
+        index['scanned'] = end
+        position = end
 
+
+def _scan_outcar(mm, position, index):
+    """Append the offsets of all complete OUTCAR ionic steps after position to index."""
+    if not index['offsets'] and position == 0:
+        #frames start after the line of the first SCF iteration (see ase build_header)
+        found = mm.find(b'Iteration')
+        if found < 0:
+            return
+        position = mm.find(b'\n', found) + 1
+        if position == 0:
+            return
+        index['scanned'] = position
+    while True:
+        found = mm.find(OUTCAR_DELIMITER, position)
+        if found < 0:
+            return
+        end = found
+        #delimiter line plus 4 lines containing the energies
+        for _ in range(5):
+            end = mm.find(b'\n', end) + 1
+            if end == 0:
+                return
+        index['offsets'].append(position)
+        index['scanned'] = end
+        position = end
+
+
+def index_file(inFile):
+    """Where the frame index of inFile is stored: VASPTOOLS_CACHE/frame-index, named by the hash of its real path."""
+    from gridcache import cache_dir
+    name = hashlib.sha1(os.path.realpath(inFile).encode()).hexdigest()
+    return os.path.join(cache_dir(), INDEX_DIR, name + '.idx')
+
+
+def frame_index(inFile, persist=True):
+    """Byte offsets of the frames of an XDATCAR or OUTCAR.
+    The index is stored in the cache (see index_file), reused if size and mtime did not
+    change and updated incrementally if the file was appended to (e.g. by a running job).
+    Returns a dict with the offsets of the frames ('offsets'), for XDATCARs the offsets of
+    the header belonging to every frame ('headers'), and the scanned part of the file.
+    """
+    indexFile = index_file(inFile)
+    stat = os.stat(inFile)
+    index = None
+    if os.path.isfile(indexFile):
+        try:
+            with open(indexFile) as f:
+                index = json.load(f)
+        except ValueError:
+            index = None
+    if index and index['size'] == stat.st_size and index['mtime'] == stat.st_mtime_ns:
+        return index
+
+    xdatcar = "xdatcar" in inFile.lower()
+    with open(inFile, 'rb') as f:
+        if stat.st_size == 0:
+            return {'offsets': [], 'headers': [], 'scanned': 0, 'natoms': 0}
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        #only continue scanning if the file was appended to
+        if not (index and index['size'] <= stat.st_size and index['tail'] == _tail_hash(mm, index['scanned'])):
+            index = {'offsets': [], 'headers': [], 'scanned': 0, 'natoms': 0}
+        if xdatcar:
+            _scan_xdatcar(mm, index['scanned'], index)
+        else:
+            _scan_outcar(mm, index['scanned'], index)
+        index['tail'] = _tail_hash(mm, index['scanned'])
+        mm.close()
+    index['size'] = stat.st_size
+    index['mtime'] = stat.st_mtime_ns
+    if persist:
+        #write and rename, parallel runs on the same file must not read a truncated index
+        tmp = '{}.{}'.format(indexFile, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(indexFile), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp, indexFile)
+        except OSError as e:
+            print('ATTENTION: Could not store the frame index of {:}: {:}'.format(inFile, e))
+    return index
+
+
+def count(inFile):
+    """Number of complete frames in an XDATCAR or OUTCAR, using the frame index."""
+    return len(frame_index(inFile)['offsets'])
+
+
+def read_frames(inFile, indices):
+    """Yield the frames with the given indices of an XDATCAR or OUTCAR, seeking directly to them."""
+    offsets = frame_index(inFile)
+    with open(inFile) as fd:
+        if "xdatcar" in inFile.lower():
+            headers = {}
+            for k in indices:
+                if offsets['headers'][k] not in headers:
+                    fd.seek(offsets['headers'][k])
+                    headers[offsets['headers'][k]] = _read_xdatcar_header(fd)
+                fd.seek(offsets['offsets'][k])
+                fd.readline()
+                yield _read_xdatcar_frame(fd, headers[offsets['headers'][k]])
+        else:
+            header = OutcarHeaderParser(workdir=os.path.dirname(os.path.abspath(inFile))).build(build_header(fd))
+            for k in indices:
+                fd.seek(offsets['offsets'][k])
+                yield OUTCARChunk(build_chunk(fd), header).build()
+
+
+def iread(inFile):
+    """Yield the frames of an XDATCAR or OUTCAR lazily."""
+    with open(inFile) as fd:
+        if "xdatcar" in inFile.lower():
+            yield from iread_xdatcar(fd)
+        else:
+            yield from iread_vasp_out(fd, index=slice(0, None))
+
+
+def iter_frames(inFiles, start=0, stop=None, every=1, wrap=False, skip=0, index=True):
+    """Chain the frames of all inFiles and yield every every-th frame from start to stop,
+    leaving out the first skip of them.
+    With index, the frames are located with frame_index and read directly,
+    negative start and stop count from the end then.
+    """
     for inFile in inFiles:
         if not os.path.isfile(inFile):
             raise ValueError('File {:} does not exist'.format(str(inFile)))
+    if index:
+        try:
+            with stage('index'):
+                counts = [count(inFile) for inFile in inFiles]
+        except OSError as e:
+            print('ATTENTION: Could not index the frames, reading them sequentially: {:}'.format(e))
+            index = False
+    if index:
+        selected = list(range(sum(counts))[start:stop:every][skip:])
+        first = 0
+        frames = []
+        for inFile, n in zip(inFiles, counts):
+            local = [k - first for k in selected if first <= k < first + n]
+            if local:
+                frames.append(read_frames(inFile, local))
+            first += n
+        frames = chain.from_iterable(frames)
+    else:
+        frames = chain.from_iterable(iread(inFile) for inFile in inFiles)
+        frames = islice(islice(frames, start, stop, every), skip, None)
+    for frame in frames:
+        if wrap:
+            frame.wrap(center=(0.0,0.0,0.0))
+        yield frame
 
 
-        if "xdatcar" in inFile.lower():
-            mol = io.read(inFile, format='vasp-xdatcar', index=slice(0,None))
-        else:
-            mol = io.read(inFile, format='vasp-out', index=slice(0,None))
+def guess_format(outFile):
+    """Trajectory format from the file extension: 'traj', 'h5' or 'extxyz' (default)."""
+    extension = os.path.splitext(outFile)[1].lower()
+    if extension == '.traj':
+        return 'traj'
+    if extension in ('.h5', '.hdf5'):
+        return 'h5'
+    return 'extxyz'
+
+
+def _flush_h5(f, buffer, compress, chunk_size):
+    """Append the buffered frames to the resizable datasets of an HDF5 trajectory.
+    The datasets are created with chunks of chunk_size frames, also if the first buffer is shorter.
+    """
+    natoms = len(buffer[0].numbers)
+    if any(len(frame.numbers) != natoms for frame in buffer):
+        raise ValueError("HDF5 trajectories need the same atoms in every frame")
+    arrays = {'positions': np.array([frame.positions for frame in buffer]),
+              'cells': np.array([frame.cell[:] for frame in buffer]),
+              'energies': np.full(len(buffer), np.nan),
+              'forces': np.full((len(buffer), natoms, 3), np.nan)}
+    for i, frame in enumerate(buffer):
+        if frame.calc is not None:
+            arrays['energies'][i] = frame.calc.results.get('energy', np.nan)
+            if 'forces' in frame.calc.results:
+                arrays['forces'][i] = frame.calc.results['forces']
+    if 'numbers' not in f:
+        f.create_dataset('numbers', data=buffer[0].numbers)
+        f.create_dataset('pbc', data=buffer[0].pbc)
+        for key, value in arrays.items():
+            f.create_dataset(key, data=value, maxshape=(None,) + value.shape[1:], chunks=(chunk_size,) + value.shape[1:],
+                             compression='gzip' if compress else None)
+    elif not np.array_equal(f['numbers'][:], buffer[0].numbers):
+        raise ValueError("HDF5 trajectories need the same atoms in every frame")
+    else:
+        for key, value in arrays.items():
+            n = f[key].shape[0]
+            f[key].resize(n + len(value), axis=0)
+            f[key][n:] = value
+
 
-        for frame in mol:
-            if wrap:
-                frame.wrap(center=(0.0,0.0,0.0))
-            frame.write(outFile,append=True)
+def write_frames(outFile, frames, format=None, append=False, compress=False, chunk_size=1000):
+    """Write an iterable of frames through a single open file.
+        format: 'extxyz', 'traj' (ASE trajectory) or 'h5' (HDF5 with positions,
+                cells, energies and forces as contiguous float64 arrays,
+                missing energies/forces are NaN), None: guess from outFile
+        append: append to an existing file
+        compress: gzip compression of the HDF5 datasets
+        chunk_size: frames per HDF5 chunk, frames are buffered and appended chunk-wise
+    """
+    format = format or guess_format(outFile)
+    if format == 'extxyz':
+        with open(outFile, 'a' if append else 'w') as f:
+            write_extxyz(f, frames)
+    elif format == 'traj':
+        from ase.io.trajectory import Trajectory
+        with Trajectory(outFile, 'a' if append else 'w') as traj:
+            for frame in frames:
+                traj.write(frame)
+    elif format == 'h5':
+        import h5py
+        with h5py.File(outFile, 'a' if append else 'w') as f:
+            buffer = []
+            for frame in frames:
+                buffer.append(frame)
+                if len(buffer) == chunk_size:
+                    _flush_h5(f, buffer, compress, chunk_size)
+                    buffer = []
+            if buffer:
+                _flush_h5(f, buffer, compress, chunk_size)
+    else:
+        raise ValueError("Unknown trajectory format {}".format(format))
+
+
+def read_h5(filename):
+    """Read an HDF5 trajectory written by write_frames, returns a dict of numpy arrays."""
+    import h5py
+    with h5py.File(filename, 'r') as f:
+        return {key: f[key][:] for key in f.keys()}
+
+
+def count_frames(filename, format=None):
+    """Number of complete frames in a trajectory, a partially written last extxyz frame is cut off."""
+    format = format or guess_format(filename)
+    if format == 'traj':
+        from ase.io.trajectory import Trajectory
+        with Trajectory(filename) as traj:
+            return len(traj)
+    if format == 'h5':
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            return f['positions'].shape[0] if 'positions' in f else 0
+    complete = 0
+    offset = 0
+    with open(filename, 'rb') as f:
+        while True:
+            line = f.readline()
+            if not line.strip():
+                break
+            lines = list(islice(f, int(line) + 1))
+            if len(lines) < int(line) + 1 or not lines[-1].endswith(b'\n'):
+                break
+            complete += 1
+            offset = f.tell()
+    if offset != os.path.getsize(filename):
+        print('ATTENTION: Removing incomplete last frame of {:}'.format(filename))
+        os.truncate(filename, offset)
+    return complete
+
+
+def main(outFile, inFiles, wrap, start=0, stop=None, every=1, resume=False, index=True, format=None, compress=False):
+    """
+        start, stop, every: only write every every-th frame from start to stop
+                            (counted over all inFiles)
+        resume: append only the frames not yet in outFile
+        index: use (and store) byte offsets of the frames, see frame_index
+        format: 'extxyz', 'traj' or 'h5', see write_frames, None: guess from outFile
+        compress: compress the HDF5 datasets
+    """
+    skip = 0
+    if resume and os.path.isfile(outFile):
+        skip = count_frames(outFile, format)
+        print("Found {:} frames in {:}, appending the rest.".format(skip, outFile))
+    elif os.path.isfile(outFile):
+        #if output exists mv to .bak
+        print('ATTENTION: {:} exists, moving to *.bak'.format(outFile))
+        os.rename(outFile, outFile+'.bak')
+
+    #all inputs end up in one output, so a single profile record for all of them
+    with profile('vasp2traj', inFiles):
+        frames = iterate('parse', iter_frames(inFiles, start, stop, every, wrap, skip=skip, index=index))
+        with stage('write'):
+            write_frames(outFile, frames, format=format, append=skip > 0, compress=compress)
     return
 
 
 
 if __name__ == "__main__":
     import argparse
-    parser = argparse.ArgumentParser(description='Convert VASP output to ASE-extxyz trajectory')
+    parser = argparse.ArgumentParser(description='Convert VASP output to ASE-extxyz (or ASE/HDF5 binary) trajectory')
     parser.add_argument('-w', help='Wrap structure with origin as center', action='store_const', default=False, const=True)
+    parser.add_argument('--start', help='First frame to write', type=int, default=0)
+    parser.add_argument('--stop', help='Stop before this frame', type=int, default=None)
+    parser.add_argument('--every', help='Only write every N-th frame', type=int, default=1)
+    parser.add_argument('--resume', help='Only append frames missing in the output file', action='store_true')
+    parser.add_argument('--noindex', help='Do not use or store the frame offsets cached in VASPTOOLS_CACHE, read all frames sequentially', action='store_true')
+    parser.add_argument('--format', help='Output format, default: guess from the output file (*.traj, *.h5, otherwise extxyz)', choices=['extxyz', 'traj', 'h5'], default=None)
+    parser.add_argument('--compress', help='Compress the HDF5 output', action='store_true')
+    parser.add_argument('--count', help='Only print the number of frames of the input files (output is taken as input too)', action='store_true')
     parser.add_argument('output', type=str, help='output file')
     parser.add_argument('input', type=str, help='input xyz file(s)', nargs='*')
+    add_profile_arguments(parser)
     args = parser.parse_args()
-    main(args.output, args.input, args.w)
-
-
+    setup(args)
+    if args.count:
+        for inFile in [args.output] + args.input:
+            print("{:} {:}".format(count(inFile), inFile))
+    else:
+        main(args.output, args.input, args.w, start=args.start, stop=args.stop, every=args.every, resume=args.resume, index=not args.noindex,
+             format=args.format, compress=args.compress)
@@ -4,47 +4,163 @@
 # by Patrick Melix
 # 2021/06/15
 #
-from ase.calculators.vasp.vasp import Vasp
+# Convergence is decided from the end of the OUTCAR and a few INCAR keys,
+# the ASE calculator is only loaded for the full check (--full).
+#
+from outcarscan import find_last
+from vasprunscan import iter_calculations
 import os
 import numpy as np
 
 
-def check_vasp_occupations(calc):
+def occupations(calculation):
+    """Occupations of a <calculation> element of vasprun.xml as array of shape (spin, kpoint, band),
+    None if it contains no eigenvalues.
+    """
+    eigenvalues = calculation.find('eigenvalues/array/set')
+    if eigenvalues is None:
+        return None
+    nSpins = len(eigenvalues)
+    nKpoints = len(eigenvalues[0])
+    #rows of eigenvalue and occupation
+    values = np.fromstring(' '.join(r.text for spin in eigenvalues for kpoint in spin for r in kpoint), sep=' ')
+    return values.reshape(nSpins, nKpoints, -1, 2)[..., 1]
+
+
+def read_occupations(filename, all_steps=False):
+    """Occupations from vasprun.xml, streaming through the ionic steps.
+    Returns a list of (step, occupations) of the last step containing eigenvalues or all of them.
+    """
+    steps = []
+    for i, calculation in enumerate(iter_calculations(filename)):
+        occ = occupations(calculation)
+        if occ is None:
+            continue
+        if all_steps:
+            steps.append((i, occ))
+        else:
+            steps = [(i, occ)]
+    return steps
+
+
+def bad_occupations(occ, tol=1e-4):
+    """Indices (spin, kpoint, band) and deviations of all occupations that are neither 0 nor fully occupied,
+    sorted with the worst first.
+    """
+    electrons = 1.0 if occ.shape[0] == 2 else 2.0
+    deviation = np.minimum(np.abs(occ - electrons), np.abs(occ))
+    bad = np.argwhere(deviation > tol)
+    worst = np.argsort(-deviation[tuple(bad.T)], kind='stable')
+    return bad[worst], deviation[tuple(bad[worst].T)]
+
+
+def check_occupations(occ, tol=1e-4, n_worst=5):
+    """Returns None if all occupations are 0 or fully occupied, otherwise a message
+    with the number of bad occupations and the worst of them."""
+    bad, deviation = bad_occupations(occ, tol)
+    if len(bad) == 0:
+        return None
+    msg = ["Bad Occupation found: {} of {} occupations (spin, kpoint, band) deviate by more than {}, worst:".format(len(bad), occ.size, tol)]
+    for (s, k, b), d in zip(bad[:n_worst], deviation[:n_worst]):
+        msg.append("  spin {} kpoint #{} band #{}: {:.4f}".format(s, k, b, occ[s, k, b]))
+    return "\n".join(msg)
+
+
+def check_vasp_occupations(calc, all_steps=False, tol=1e-4):
     """Check VASP calculations.
+    calc: ASE Vasp calculator or path of the calculation
     Returns None if everything is good.
     Returns a string with a message if a problem occurs.
     """
-    xml = calc._read_xml()
-    if xml.get_spin_polarized():
-        spins = [0, 1]
-        electrons = 1.0
-    else:
-        spins = [0]
-        electrons = 2.0
-
-    nkpoints = len(xml.get_ibz_k_points())
-    for s in spins:
-        for i in range(nkpoints):
-            occ = xml.get_occupation_numbers(i, s)
-            if occ is None:
-                msg = "No occupations found in vasprun.xml for kpoint" +\
-                      " #{} and spin {}!"
-                return msg.format(i, s)
-            test = np.where(np.logical_or(occ == electrons, occ == 0.0), 1, 0)
-            if not test.all():
-                return "Bad Occupation found"
-
-
-def main(path):
+    filename = os.path.join(getattr(calc, 'directory', calc), 'vasprun.xml')
+    steps = read_occupations(filename, all_steps)
+    if not steps:
+        return "No occupations found in {}!".format(filename)
+    msgs = []
+    for i, occ in steps:
+        msg = check_occupations(occ, tol)
+        if msg:
+            msgs.append("Ionic step #{}: {}".format(i, msg) if all_steps else msg)
+    if msgs:
+        return "\n".join(msgs)
+
+
+def read_incar(path, keys=('NELM', 'EDIFFG', 'IBRION', 'NSW')):
+    """Values of keys in path/INCAR, VASP defaults for keys that are not set."""
+    values = {}
+    incar = os.path.join(path, 'INCAR')
+    if os.path.isfile(incar):
+        with open(incar) as f:
+            for line in f:
+                line = line.split('!')[0].split('#')[0]
+                for statement in line.split(';'):
+                    if '=' not in statement:
+                        continue
+                    key, value = statement.split('=', 1)
+                    key = key.strip().upper()
+                    if key in keys and value.split():
+                        values[key] = float(value.split()[0])
+    values.setdefault('NELM', 60)
+    values.setdefault('NSW', 0)
+    values.setdefault('IBRION', -1 if values['NSW'] in (0, 1) else 0)
+    values.setdefault('EDIFFG', None)
+    return {key: (int(v) if key != 'EDIFFG' else v) for key, v in values.items() if key in keys}
+
+
+def check_convergence(path):
+    """SCF and GO convergence of the last ionic step from the end of path/OUTCAR.
+    Returns a dict with scf (bool), ionic (bool, None if not a relaxation with IBRION 1-3),
+    the number of ionic and electronic steps of the last ionic step and the INCAR values used.
+    """
+    incar = read_incar(path)
+    iteration = b'Iteration'
+    aborting = b'aborting loop'
+    relaxed = b'reached required accuracy'
+    with open(os.path.join(path, 'OUTCAR'), 'rb') as f:
+        #everything of interest is written after the last Iteration line
+        found = find_last(f, [iteration, aborting, relaxed], stop=iteration)
+        if iteration not in found:
+            raise ValueError("No electronic steps found in {}".format(os.path.join(path, 'OUTCAR')))
+        #----- Iteration    5(  23)  -----
+        f.seek(found[iteration])
+        ionic, electronic = f.readline().decode().split('Iteration')[1].split(')')[0].replace('(', ' ').split()
+        result = dict(incar, ionic_steps=int(ionic), electronic_steps=int(electronic))
+        if found.get(aborting, -1) > found[iteration]:
+            #VASP 6 states why the loop ended
+            f.seek(found[aborting])
+            result['scf'] = b'because EDIFF is reached' in f.readline()
+        else:
+            result['scf'] = result['electronic_steps'] < incar['NELM']
+    result['ionic'] = None
+    if incar['IBRION'] in (1, 2, 3) and incar['NSW'] > 0:
+        result['ionic'] = found.get(relaxed, -1) > found[iteration]
+    return result
+
+
+def main(path, all_steps=False, tol=1e-4, full=False):
+    """
+        all_steps: check the occupations of every ionic step, not only the last one
+        tol: allowed deviation of the occupations from 0 or full occupation
+        full: decide convergence with the ASE Vasp calculator reading the complete OUTCAR
+    """
     assert os.path.isdir(path), "Given path is not a directory"
-    calc = Vasp(directory=path)
-    ret = check_vasp_occupations(calc)
+    ret = check_vasp_occupations(path, all_steps, tol)
     if ret:
         print(ret)
         return
-    print("Seems like there are no bad occupations (only last step).")
+    print("Seems like there are no bad occupations ({}).".format('all steps' if all_steps else 'only last step'))
 
-    if not calc.read_convergence():
+    if full:
+        from ase.calculators.vasp.vasp import Vasp
+        converged = Vasp(directory=path).read_convergence()
+    else:
+        convergence = check_convergence(path)
+        if not convergence['scf']:
+            print("SCF did not converge within NELM = {} steps in ionic step {}!".format(convergence['NELM'], convergence['ionic_steps']))
+        if convergence['ionic'] is False:
+            print("GO did not reach EDIFFG = {} after {} of NSW = {} steps!".format(convergence['EDIFFG'], convergence['ionic_steps'], convergence['NSW']))
+        converged = convergence['scf'] and convergence['ionic'] is not False
+    if not converged:
         print("Either SCF or GO did not converge!")
     else:
         print("No convergence issues found (only last step).")
@@ -60,5 +176,18 @@ if __name__ == "__main__":
         type=str,
         help='path to VASP files',
         default='./')
+    parser.add_argument(
+        '--all',
+        help='check the occupations of every ionic step',
+        action='store_true')
+    parser.add_argument(
+        '--tol',
+        type=float,
+        help='allowed deviation from 0 or full occupation',
+        default=1e-4)
+    parser.add_argument(
+        '--full',
+        help='decide convergence by reading the complete OUTCAR with ASE',
+        action='store_true')
     args = parser.parse_args()
-    main(args.path)
+    main(args.path, args.all, args.tol, args.full)
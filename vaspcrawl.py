@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+#
+# Script to check occupations and SCF+GO convergence of all VASP runs in a directory tree
+# using vaspcheck.py, writes a JSON or CSV report.
+#
+# The results are cached (default .vaspcrawl.json in the root folder) keyed by size and
+# modification time of vasprun.xml and OUTCAR, so a rerun only checks new or changed runs.
+#
+# You can import the module and then call .main() or use it as a script
+from batch import run_batch
+from vaspcheck import check_convergence, check_vasp_occupations
+import csv, json, os
+
+COLUMNS = ['path', 'occupations_ok', 'converged', 'message']
+INPUTS = ['vasprun.xml', 'OUTCAR']
+
+
+def find_runs(root='.'):
+    """All folders below root containing vasprun.xml and OUTCAR."""
+    runs = []
+    for path, dirs, files in os.walk(root):
+        dirs.sort()
+        if all(f in files for f in INPUTS):
+            runs.append(path)
+    return runs
+
+
+def signature(path):
+    """Size and modification time of the inputs, the INCAR decides the convergence criteria."""
+    files = [f for f in INPUTS + ['INCAR'] if os.path.isfile(os.path.join(path, f))]
+    return [[f, os.path.getsize(os.path.join(path, f)), os.stat(os.path.join(path, f)).st_mtime_ns] for f in files]
+
+
+def check_run(path, all_steps=False, tol=1e-4, full=False):
+    """Check one run, returns a dict with the keys of COLUMNS, problems reading the run end up in message.
+    full: decide convergence with the ASE Vasp calculator, see vaspcheck.main
+    """
+    result = {'path': path, 'occupations_ok': None, 'converged': None, 'message': ''}
+    try:
+        msg = check_vasp_occupations(path, all_steps, tol)
+        result['occupations_ok'] = msg is None
+        result['message'] = msg or ''
+        if full:
+            from ase.calculators.vasp.vasp import Vasp
+            result['converged'] = bool(Vasp(directory=path).read_convergence())
+        else:
+            convergence = check_convergence(path)
+            result['converged'] = convergence['scf'] and convergence['ionic'] is not False
+    except Exception as e:
+        result['message'] = 'ERROR: {}'.format(e)
+    return result
+
+
+def write_report(filename, rows):
+    """Write rows as CSV if filename ends with .csv, otherwise as JSON."""
+    if filename.endswith('.csv'):
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        return
+    with open(filename, 'w') as f:
+        json.dump(rows, f, indent=1)
+
+
+def main(root='.', outFile='vaspcrawl.json', all_steps=False, tol=1e-4, full=False, cacheFile=None, rerun=False, workers=1, verbose=True):
+    """
+        root: directory tree to search for VASP runs (folders with vasprun.xml and OUTCAR)
+        outFile: report with one entry per run, *.csv or JSON
+        all_steps, tol, full: see vaspcheck.main
+        cacheFile: results of earlier runs, default root/.vaspcrawl.json
+        rerun: check all runs again, ignoring the cache
+        workers: number of runs checked in parallel
+    """
+    runs = find_runs(root)
+    if verbose: print("Found {:} VASP runs below {:}".format(len(runs), root))
+    if cacheFile is None:
+        cacheFile = os.path.join(root, '.vaspcrawl.json')
+    cache = {}
+    if not rerun and os.path.isfile(cacheFile):
+        try:
+            with open(cacheFile) as f:
+                cache = json.load(f)
+        except ValueError:
+            print('ATTENTION: {:} is broken, checking all runs again'.format(cacheFile))
+            cache = {}
+    options = {'all_steps': all_steps, 'tol': tol, 'full': full}
+
+    signatures = {path: signature(path) for path in runs}
+    todo = [path for path in runs if path not in cache
+            or cache[path]['signature'] != signatures[path] or cache[path]['options'] != options]
+    if verbose: print("Checking {:} new or changed runs".format(len(todo)))
+    results, failed = run_batch(check_run, [(path, all_steps, tol, full) for path in todo], workers=workers, verbose=verbose)
+    for path, result in zip(todo, results):
+        if result is not None:
+            cache[path] = {'signature': signatures[path], 'options': options, 'result': result}
+
+    rows = [cache[path]['result'] for path in runs if path in cache]
+    write_report(outFile, rows)
+    #write and rename, an interrupted run must not leave a truncated cache
+    tmp = '{}.{}'.format(cacheFile, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp, cacheFile)
+    if verbose:
+        print("Bad occupations: {:}, not converged: {:}, errors: {:}".format(
+              sum(r['occupations_ok'] is False for r in rows), sum(r['converged'] is False for r in rows),
+              sum(r['message'].startswith('ERROR') for r in rows)))
+        print("Wrote report of {:} runs to {:}".format(len(rows), outFile))
+    return rows
+
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Check occupations and convergence of all VASP runs in a directory tree')
+    parser.add_argument('root', type=str, help='Directory to search, default: .', nargs='?', default='.')
+    parser.add_argument('-o', type=str, help='Report, *.csv or JSON', default='vaspcrawl.json')
+    parser.add_argument('--all', help='Check the occupations of every ionic step', action='store_true')
+    parser.add_argument('--tol', type=float, help='Allowed deviation from 0 or full occupation', default=1e-4)
+    parser.add_argument('--full', help='Decide convergence by reading the complete OUTCAR with ASE', action='store_true')
+    parser.add_argument('--cache', type=str, help='Cache file, default: ROOT/.vaspcrawl.json', default=None)
+    parser.add_argument('--nocache', help='Check all runs again', action='store_true')
+    parser.add_argument('--jobs', help='Number of runs to check in parallel', type=int, default=1)
+    args = parser.parse_args()
+    main(args.root, args.o, args.all, args.tol, args.full, args.cache, args.nocache, args.jobs)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+#
+# Script to get the energy and maximum force of every ionic step from (many) vasprun.xml
+# with an incremental XML parser, replaces vef.py of VTST.
+#
+# Only one ionic step is kept in memory at a time and truncated files of killed
+# jobs are fine, all completed ionic steps are returned.
+#
+# You can import the module and then call .read_fe(), .read_many() or .iter_calculations() or use it as a script
+from batch import run_batch
+from profiling import add_profile_arguments, profile, setup, stage
+import xml.etree.ElementTree as ET
+import numpy as np
+import os
+
+
+class FeParser:
+    """Incremental parser of vasprun.xml, feed it bytes with .feed() to get the new ionic steps.
+    offset: number of bytes fed so far
+    steps: (energy, max force) of all ionic steps so far
+    head: the first (up to) HEAD bytes fed, identify the file together with inode
+    """
+    HEAD = 4096
+
+    def __init__(self):
+        self.parser = ET.XMLPullParser(events=('start', 'end'))
+        self.root = None
+        self.selective = None
+        self.offset = 0
+        self.steps = []
+        self.head = b''
+        self.inode = None
+
+    def feed(self, data):
+        """Parse data, returns a list of (energy, max force) of the ionic steps completed by it."""
+        self.parser.feed(data)
+        self.offset += len(data)
+        steps = []
+        for event, elem in self.parser.read_events():
+            if event == 'start':
+                if self.root is None:
+                    self.root = elem
+                continue
+            if elem.tag == 'structure' and elem.get('name') == 'initialpos':
+                #fixed coordinates of selective dynamics do not count for the force
+                selective = elem.find("varray[@name='selective']")
+                if selective is not None:
+                    self.selective = np.array([v.text.split() for v in selective]) == 'T'
+            elif elem.tag == 'calculation':
+                steps.append(self._step(elem))
+                #drop everything parsed so far
+                self.root.clear()
+        self.steps.extend(steps)
+        return steps
+
+    def read_new(self, filename, blocksize=2**20):
+        """Parse what was appended to filename since the last call, returns the new ionic steps.
+        Starts over if the file was replaced by a new run: another inode, shorter than
+        what was read or a different beginning (VASP writes the date and time there).
+        """
+        steps = []
+        with open(filename, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            replaced = self.inode is not None and stat.st_ino != self.inode
+            if replaced or stat.st_size < self.offset or f.read(len(self.head)) != self.head:
+                print('ATTENTION: {:} was replaced, reading it again'.format(filename))
+                self.__init__()
+            self.inode = stat.st_ino
+            f.seek(self.offset)
+            for block in iter(lambda: f.read(blocksize), b''):
+                if len(self.head) < self.HEAD:
+                    self.head += block[:self.HEAD - len(self.head)]
+                steps.extend(self.feed(block))
+        return steps
+
+    def _step(self, calculation):
+        energy = float(calculation.find("energy/i[@name='e_fr_energy']").text)
+        forces = np.array([v.text.split() for v in calculation.find("varray[@name='forces']")], dtype=float)
+        if self.selective is not None:
+            forces *= self.selective
+        return energy, np.linalg.norm(forces, axis=1).max()
+
+
+def iter_calculations(filename, blocksize=2**20):
+    """Yields the <calculation> elements (ionic steps) of filename one at a time, each is
+    cleared once the next one is parsed. A truncated file ends after the last complete step.
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    root = None
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            try:
+                parser.feed(block)
+            except ET.ParseError as e:
+                print('ATTENTION: {:} is broken: {:}'.format(filename, e))
+                return
+            for event, elem in parser.read_events():
+                if event == 'start':
+                    if root is None:
+                        root = elem
+                elif elem.tag == 'calculation':
+                    yield elem
+                    root.clear()
+
+
+def read_fe(filename, blocksize=2**20):
+    """Energy (free energy TOTEN) and maximum atomic force of all completed ionic steps in filename.
+    Returns an array of shape (nSteps, 2).
+    """
+    parser = FeParser()
+    with profile('vasprunscan', filename), stage('parse'):
+        try:
+            parser.read_new(filename, blocksize)
+        except ET.ParseError as e:
+            print('ATTENTION: {:} is broken after {:} steps: {:}'.format(filename, len(parser.steps), e))
+    return np.array(parser.steps, dtype=float).reshape(-1, 2)
+
+
+def read_many(filenames, workers=1):
+    """read_fe for many files in a process pool, returns a list of arrays in the order of filenames."""
+    return run_batch(read_fe, [(filename,) for filename in filenames], workers=workers)[0]
+
+
+def write_fe(filename, energies, forces):
+    """Write the series as json (lists energy and force) or as numpy .npz file."""
+    if filename.endswith('.npz'):
+        np.savez(filename, energy=energies, force=forces)
+        return
+    import json
+    with open(filename, 'w') as f:
+        json.dump({'force': list(map(float, forces)), 'energy': list(map(float, energies))}, f)
+
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Print energy and maximum force of all ionic steps in vasprun.xml files, like vef.py.')
+    parser.add_argument('input', type=str, nargs='*', help='vasprun.xml files', default=['vasprun.xml'])
+    parser.add_argument('--jobs', help='Number of files to read in parallel', type=int, default=1)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    setup(args)
+    for filename, fe in zip(args.input, read_many(args.input, workers=args.jobs)):
+        if fe is None:
+            continue
+        print(filename)
+        for i, (energy, force) in enumerate(fe):
+            print('{:5d} {:16.8f} {:16.8f}'.format(i, force, energy))
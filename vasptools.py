@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+# Single entry point for the tools: vasptools.py SUBCOMMAND [arguments of SUBCOMMAND.py]
+#
+# Only the script of the subcommand is loaded, ASE, pymatgen and matplotlib are imported when
+# a subcommand needs them. To pay these imports only once, many jobs can be run by one process,
+# either from a job list (one subcommand per line, optionally starting with -C DIR, - for stdin)
+#   vasptools.py jobs jobs.txt
+# or from a local socket:
+#   vasptools.py serve /tmp/vasptools.sock &
+#   vasptools.py send /tmp/vasptools.sock chgcar2cube CHGCAR -o density
+#   vasptools.py send /tmp/vasptools.sock stop
+#
+# You can import the module and then call .run() or use it as a script
+from contextlib import redirect_stderr, redirect_stdout
+import io, json, os, runpy, shlex, socket, sys, traceback
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+COMMANDS = {
+    'add-MODECAR': 'Add MODECAR displacements to the POSCAR',
+    'benchmark': 'Benchmark the tools on synthetic VASP output',
+    'chgcar2cube': 'Convert CHGCAR files to cube files',
+    'deformationdensity': 'Deformation density AB-(A+B) of three CHGCARs',
+    'elf2cube': 'Convert ELFCAR files to cube files',
+    'freq2jmol': 'Write vibrations as jmol file and xyz animations',
+    'gridcache': 'Manage the cache of parsed grids',
+    'neb2movie': 'Convert a VASP NEB to a movie',
+    'nebsurvey': 'Collect barriers of all NEBs in a directory tree',
+    'outcarscan': 'Last energy, force and magnetization of OUTCARs',
+    'plotNEB': 'Plot energies and forces of a VTST NEB',
+    'poscar2nbands': 'NBANDS for LOBSTER',
+    'vasp-combine-vef': 'Plot energy and forces of multiple GO runs',
+    'vasp2traj': 'Convert VASP output to an ext-xyz trajectory',
+    'vaspcheck': 'Check occupations and convergence of a VASP run',
+    'vaspcrawl': 'Check all VASP runs in a directory tree',
+    'vasprunscan': 'Energy and maximum force of vasprun.xml files',
+}
+
+
+def script(command):
+    """Path of the script of a subcommand."""
+    if command not in COMMANDS:
+        raise ValueError("Unknown subcommand {}, choose from: {}".format(command, ', '.join(COMMANDS)))
+    return os.path.join(DIR, command + '.py')
+
+
+def run(argv, cwd=None):
+    """Run the subcommand argv[0] with the arguments argv[1:] just like its script, in folder cwd.
+    Returns the exit status, exceptions of the script are raised.
+    """
+    path = script(argv[0])
+    oldArgv, oldCwd = sys.argv, os.getcwd()
+    #scripts may change the environment (e.g. --profile), do not pass it on to the next job
+    oldEnviron = dict(os.environ)
+    sys.argv = [path] + list(argv[1:])
+    if DIR not in sys.path:
+        sys.path.insert(0, DIR)
+    try:
+        if cwd:
+            os.chdir(cwd)
+        runpy.run_path(path, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    finally:
+        sys.argv = oldArgv
+        os.chdir(oldCwd)
+        os.environ.clear()
+        os.environ.update(oldEnviron)
+    return 0
+
+
+def parse_job(line):
+    """Arguments and folder of a job line: [-C DIR] SUBCOMMAND [arguments], None for empty lines and comments."""
+    argv = shlex.split(line, comments=True)
+    if not argv:
+        return None
+    cwd = None
+    if argv[0] == '-C':
+        if len(argv) < 3:
+            raise ValueError("Job without subcommand: {}".format(line.strip()))
+        cwd, argv = argv[1], argv[2:]
+    script(argv[0])
+    return argv, cwd
+
+
+def run_safe(argv, cwd=None):
+    """Like run but prints the traceback of a failing script instead of raising it (status 1)."""
+    try:
+        return run(argv, cwd)
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+
+def run_jobs(filename='-', verbose=True):
+    """Run all jobs of a job list (see parse_job), - reads them from stdin.
+    Failing jobs do not stop the others, returns the number of failed jobs.
+    """
+    f = sys.stdin if filename == '-' else open(filename)
+    failed = 0
+    for line in f:
+        try:
+            job = parse_job(line)
+        except ValueError as e:
+            print('FAILED: {}'.format(e))
+            failed += 1
+            continue
+        if job is None:
+            continue
+        if run_safe(*job) != 0:
+            print('FAILED: {}'.format(line.strip()))
+            failed += 1
+        sys.stdout.flush()
+    if f is not sys.stdin:
+        f.close()
+    if verbose: print("Finished jobs, {:} failed".format(failed))
+    return failed
+
+
+def _receive(conn):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data.decode())
+
+
+def serve(address, verbose=True):
+    """Run the jobs sent to the unix socket address (see send) one after another until stop is sent."""
+    if os.path.exists(address):
+        os.remove(address)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(address)
+    server.listen()
+    if verbose: print("Waiting for jobs on {:}".format(address))
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                job = _receive(conn)
+                if job['argv'] == ['stop']:
+                    conn.sendall((json.dumps({'status': 0, 'output': ''}) + '\n').encode())
+                    break
+                output = io.StringIO()
+                with redirect_stdout(output), redirect_stderr(output):
+                    status = run_safe(job['argv'], job['cwd'])
+                if verbose: print("{:} {:}: {:}".format('Done' if status == 0 else 'FAILED', job['cwd'], ' '.join(job['argv'])))
+                conn.sendall((json.dumps({'status': status, 'output': output.getvalue()}) + '\n').encode())
+    finally:
+        server.close()
+        os.remove(address)
+
+
+def send(address, argv, cwd=None):
+    """Run a subcommand in the server at address (see serve), in folder cwd (default: the current one).
+    Prints its output and returns the exit status. argv ['stop'] shuts the server down.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client:
+        client.connect(address)
+        client.sendall((json.dumps({'argv': list(argv), 'cwd': os.path.abspath(cwd or os.getcwd())}) + '\n').encode())
+        result = _receive(client)
+    sys.stdout.write(result['output'])
+    return result['status']
+
+
+def main(argv):
+    """
+        argv: SUBCOMMAND [arguments], jobs FILE, serve SOCKET or send SOCKET SUBCOMMAND [arguments]
+    """
+    if argv and argv[0] in COMMANDS:
+        return run(argv)
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Run the tools as subcommands: vasptools.py SUBCOMMAND [arguments], see SUBCOMMAND -h',
+        epilog='subcommands:\n' + '\n'.join('  {:20s}{}'.format(c, d) for c, d in COMMANDS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    modes = parser.add_subparsers(dest='mode', required=True)
+    jobs = modes.add_parser('jobs', help='Run a job list in this process, one subcommand per line ([-C DIR] SUBCOMMAND [arguments])')
+    jobs.add_argument('file', type=str, help='Job list, - for stdin', nargs='?', default='-')
+    server = modes.add_parser('serve', help='Run the jobs sent to a local socket until stop is sent')
+    server.add_argument('socket', type=str, help='Path of the socket')
+    client = modes.add_parser('send', help='Run a subcommand in the server, stop shuts it down')
+    client.add_argument('socket', type=str, help='Path of the socket')
+    client.add_argument('argv', nargs=argparse.REMAINDER, help='SUBCOMMAND [arguments]')
+    args = parser.parse_args(argv)
+    if args.mode == 'jobs':
+        return 1 if run_jobs(args.file) else 0
+    if args.mode == 'serve':
+        serve(args.socket)
+        return 0
+    return send(args.socket, args.argv)
+
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))